@@ -0,0 +1,480 @@
+"""
+    Asyncio analysis server so several tools can share one set of engine processes.
+
+    Clients connect over TCP or a Unix socket and send one JSON request per line:
+        {"id": 1, "cmd": "analyse", "fen": "...", "moves": ["e2e4"], "game": "match-1", "depth": 4, "movetime": 1.0}
+        {"id": 2, "cmd": "legal_moves", "fen": "..."}
+        {"id": 3, "cmd": "perft", "fen": "...", "depth": 3}
+        {"id": 4, "cmd": "cancel", "target": 1}
+    and get one JSON response per request, tagged with the same id:
+        {"id": 1, "ok": true, "result": {...}}
+        {"id": 2, "ok": false, "error": "..."}
+
+    fen defaults to the starting position and moves (UCI) are played on top of it. Every request
+    can give a "timeout" in seconds, which is a hard cap on how long it can take including time
+    spent queued. An analyse can give the game clock instead of a movetime ("wtime", "btime", "winc",
+    "binc", "movestogo" in seconds) to have the time for the move allocated by TimeManagement. An
+    analyse with no depth, movetime or clock searches for DEFAULT_ANALYSE_MOVETIME.
+
+    Requests are run by a fixed pool of worker processes, each holding a Search. Requests for the
+    same game always go to the same worker so they share that game's transposition table. Each
+    worker has a bounded queue, and each connection a limit on requests in flight, so a busy server
+    pushes back on clients instead of queueing without limit. A worker process that dies fails the
+    request it was running and is restarted for the rest of its queue.
+
+    Usage:
+        python AnalysisServer.py --port 8765 --workers 4
+        python AnalysisServer.py --unix /tmp/chess-engine.sock
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import ChessEngine
+import Instrumentation
+from Notation import move_to_san, move_to_uci, parse_uci
+from Search import MAX_DEPTH, Search, SearchAborted, TranspositionTable
+from Tablebase import Tablebase
+from TimeManagement import TimeManager, clock_limits
+
+COMMANDS = ['analyse', 'legal_moves', 'perft']
+DEFAULT_TIMEOUT = 30.0
+# Search time for an analyse that doesn't say how long to search
+DEFAULT_ANALYSE_MOVETIME = 1.0
+# Extra time allowed for a worker to reply after its own deadline before the request is failed
+TIMEOUT_GRACE = 1.0
+DEFAULT_QUEUE_SIZE = 8
+DEFAULT_CLIENT_REQUESTS = 16
+# Seconds to wait for a worker that has closed its pipe to exit before it is restarted
+WORKER_EXIT_WAIT = 1.0
+# Transposition tables kept per worker, one per game, least recently used are dropped first
+MAX_GAMES_PER_WORKER = 8
+GAME_TT_ENTRIES = 500000
+
+
+class RequestError(Exception):
+    """
+        Raised for requests that can't be run. The message is sent back to the client.
+    """
+
+
+def request_position(search:Search, params:dict):
+    """
+        Creates the position for a request from its fen and list of UCI moves
+    """
+    fen = params.get('fen')
+    position = ChessEngine.Position.from_fen(fen) if fen else ChessEngine.Position()
+    for uci in params.get('moves', []):
+        move = parse_uci(uci)
+        if move not in search.legal_moves(position):
+            raise RequestError(f'Illegal move: {uci}')
+        position.makeMove(move[0], move[1], move[2] or 'Q')
+    return position
+
+
+def _game_tt(tables:OrderedDict, game):
+    """
+        Gets the transposition table for a game, requests without a game get a new table
+    """
+    if game is None:
+        return TranspositionTable(GAME_TT_ENTRIES)
+    if game in tables:
+        tables.move_to_end(game)
+    else:
+        tables[game] = TranspositionTable(GAME_TT_ENTRIES)
+        if len(tables) > MAX_GAMES_PER_WORKER:
+            tables.popitem(last=False)
+    return tables[game]
+
+
+def _run_command(search:Search, tables:OrderedDict, cancel_event, cmd:str, params:dict) -> dict:
+    # The budget started when the request was submitted, so time spent queued has already been used
+    timeout = max(params['deadline'] - time.time(), 0.0)
+    position = request_position(search, params)
+
+    if cmd == 'legal_moves':
+        gs = ChessEngine.GameState(position)
+        move_list = gs.getMoveList()
+        return {
+            'moves': [move_to_uci(move) for move in move_list],
+            'san': [move_to_san(gs, move, move_list, suffix=False) for move in move_list],
+            'check': search.in_check(position),
+        }
+
+    if cmd == 'perft':
+        try:
+            nodes = search.perft(position, int(params.get('depth', 1)), movetime=timeout)
+        except SearchAborted:
+            raise RequestError('cancelled' if cancel_event.is_set() else 'timed out')
+        return {'nodes': nodes}
+
+    search.tt = _game_tt(tables, params.get('game'))
+    movetime = params.get('movetime')
+    depth = params.get('depth')
+    clock = 'wtime' in params or 'btime' in params
+    if movetime is None and depth is None and not clock:
+        movetime = DEFAULT_ANALYSE_MOVETIME
+    movetime = min(float(movetime), timeout) if movetime is not None else timeout
+    on_iteration = None
+    if clock:
+        ### Time is allocated from the clock, the request timeout still caps it
+        soft, hard = clock_limits(position.whiteToMove, float(params.get('wtime', 0)), float(params.get('btime', 0)),
+                                  float(params.get('winc', 0)), float(params.get('binc', 0)), params.get('movestogo'))
+        manager = TimeManager(soft, hard)
+        search.should_stop = lambda: cancel_event.is_set() or manager.should_stop()
+        on_iteration = manager.on_iteration
+        depth = depth if depth is not None else MAX_DEPTH
+    try:
+        result = search.search(position, depth=int(depth) if depth is not None else None, movetime=movetime, on_iteration=on_iteration)
+    finally:
+        search.should_stop = cancel_event.is_set
+    return {
+        'bestmove': move_to_uci(result.move) if result.move else None,
+        'score': result.score,
+        'depth': result.depth,
+        'nodes': result.nodes,
+        'pv': [move_to_uci(move) for move in result.pv],
+        'seconds': result.seconds,
+        'cancelled': cancel_event.is_set(),
+    }
+
+
+def _worker_main(conn, cancel_event, tablebase_dir):
+    """
+        Worker process loop. Receives (cmd, params) and replies with ('ok', result) or ('error', message)
+        until it receives None.
+    """
+    Instrumentation.worker_started()
+    search = Search(tablebase=Tablebase(tablebase_dir) if tablebase_dir else None)
+    search.should_stop = cancel_event.is_set
+    tables = OrderedDict()
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            cmd, params = message
+            try:
+                conn.send(('ok', _run_command(search, tables, cancel_event, cmd, params)))
+            except RequestError as e:
+                conn.send(('error', str(e)))
+            except Exception as e:
+                conn.send(('error', f'{type(e).__name__}: {e}'))
+    finally:
+        Instrumentation.worker_finished()
+        conn.close()
+
+
+class Job():
+
+    def __init__(self, cmd:str, params:dict, future) -> None:
+        self.cmd = cmd
+        self.params = params
+        self.future = future
+        self.worker = None
+        self.cancelled = False
+
+
+class Worker():
+    """
+        Server side handle for a worker process and its queue of jobs
+    """
+
+    def __init__(self, tablebase_dir, queue_size:int) -> None:
+        self.tablebase_dir = tablebase_dir
+        self.cancel_event = multiprocessing.Event()
+        self.queue = asyncio.Queue(queue_size)
+        self.current = None
+        self.conn = None
+        self.process = None
+
+    def start(self):
+        """
+            Starts the worker process, replacing the old one if it has died
+        """
+        if self.conn is not None:
+            self.conn.close()
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_main, args=(child_conn, self.cancel_event, self.tablebase_dir), daemon=True)
+        self.process.start()
+        # Only the worker process holds the other end now, so recv raises EOFError if it dies
+        child_conn.close()
+
+    def load(self) -> int:
+        return self.queue.qsize() + (self.current is not None)
+
+
+class AnalysisServer():
+
+    def __init__(self, workers=None, tablebase_dir=None, queue_size=DEFAULT_QUEUE_SIZE,
+                 client_requests=DEFAULT_CLIENT_REQUESTS, default_timeout=DEFAULT_TIMEOUT) -> None:
+        self.worker_count = workers or os.cpu_count() or 1
+        self.tablebase_dir = tablebase_dir
+        self.queue_size = queue_size
+        self.client_requests = client_requests
+        self.default_timeout = default_timeout
+        self.workers = []
+        self._dispatchers = []
+        self._executor = None
+        self._server = None
+        # Writer of each connected client by its handler task, so close() can disconnect them
+        self._clients = {}
+
+    async def start(self, host='127.0.0.1', port=8765, unix_path=None):
+        self.workers = [Worker(self.tablebase_dir, self.queue_size) for _ in range(self.worker_count)]
+        # Waiting on a worker's pipe blocks, so each worker gets its own thread to wait in
+        self._executor = ThreadPoolExecutor(max_workers=self.worker_count)
+        for worker in self.workers:
+            worker.start()
+            self._dispatchers.append(asyncio.create_task(self._dispatch(worker)))
+        if unix_path:
+            self._server = await asyncio.start_unix_server(self._handle_client, path=unix_path)
+        else:
+            self._server = await asyncio.start_server(self._handle_client, host, port)
+        return self._server
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+        ### Disconnect clients so their handlers finish on their own instead of being cancelled
+        for writer in self._clients.values():
+            writer.close()
+        if self._clients:
+            _, pending = await asyncio.wait(list(self._clients), timeout=TIMEOUT_GRACE)
+            for task in pending:
+                task.cancel()
+        if self._server is not None:
+            await self._server.wait_closed()
+        for task in self._dispatchers:
+            task.cancel()
+        for worker in self.workers:
+            worker.cancel_event.set()
+            try:
+                worker.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    async def _dispatch(self, worker:Worker):
+        """
+            Sends a worker its queued jobs one at a time and hands back the results
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await worker.queue.get()
+            if job.cancelled or job.future.done():
+                continue
+            if time.time() >= job.params['deadline']:
+                job.future.set_exception(RequestError('timed out'))
+                job.future.exception()
+                continue
+            # Cleared before sending so a cancel can't be lost between sending and the worker starting
+            worker.cancel_event.clear()
+            worker.current = job
+            try:
+                worker.conn.send((job.cmd, job.params))
+                status, payload = await loop.run_in_executor(self._executor, worker.conn.recv)
+            except (EOFError, OSError) as e:
+                status, payload = 'error', f'worker failed: {type(e).__name__}'
+                await self._restart_worker(worker)
+            finally:
+                worker.current = None
+            if not job.future.done():
+                if status == 'ok':
+                    job.future.set_result(payload)
+                else:
+                    job.future.set_exception(RequestError(payload))
+                    if job.cancelled:
+                        # Whoever cancelled it has already answered the client
+                        job.future.exception()
+
+    async def _restart_worker(self, worker:Worker):
+        """
+            Replaces a worker process that has died. Its queued jobs carry on with the new process.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, worker.process.join, WORKER_EXIT_WAIT)
+        if worker.process.is_alive():
+            worker.process.terminate()
+        worker.start()
+
+    def _choose_worker(self, game) -> Worker:
+        if game is not None:
+            # The same game always goes to the same worker so it can reuse its transposition table
+            return self.workers[hash(str(game)) % len(self.workers)]
+        return min(self.workers, key=Worker.load)
+
+    def cancel(self, job:Job):
+        """
+            Cancels a job. Queued jobs are dropped, a running job's worker is told to stop and returns
+            what it has so far.
+        """
+        job.cancelled = True
+        if job.worker is not None and job.worker.current is job:
+            job.worker.cancel_event.set()
+        elif not job.future.done():
+            job.future.set_exception(RequestError('cancelled'))
+            # The client may have gone away, so don't warn if nothing reads the exception
+            job.future.exception()
+
+    def create_job(self, cmd:str, params:dict) -> Job:
+        """
+            Creates a job and picks its worker without queueing it. Its time budget starts now.
+        """
+        if cmd not in COMMANDS:
+            raise RequestError(f'Unknown command: {cmd}')
+        params = dict(params)
+        params['timeout'] = min(float(params.get('timeout', self.default_timeout)), self.default_timeout)
+        # Wall clock time so the worker processes can work out how much of the budget is left
+        params['deadline'] = time.time() + params['timeout']
+        job = Job(cmd, params, asyncio.get_running_loop().create_future())
+        job.worker = self._choose_worker(params.get('game'))
+        return job
+
+    async def enqueue(self, job:Job):
+        """
+            Queues a job on its worker, waiting if the worker's queue is full. Stops waiting if the
+            job is cancelled in the meantime.
+        """
+        if job.future.done():
+            return
+        put = asyncio.ensure_future(job.worker.queue.put(job))
+        await asyncio.wait([put, job.future], return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+
+    async def submit(self, cmd:str, params:dict) -> Job:
+        """
+            Creates and queues a job. Waits if the worker's queue is full.
+        """
+        job = self.create_job(cmd, params)
+        await self.enqueue(job)
+        return job
+
+    async def result(self, job:Job) -> dict:
+        """
+            Waits for a job's result, cancelling it if the worker doesn't reply within its time budget
+        """
+        try:
+            return await asyncio.wait_for(asyncio.shield(job.future), job.params['timeout'] + TIMEOUT_GRACE)
+        except asyncio.TimeoutError:
+            self.cancel(job)
+            raise RequestError('timed out')
+
+    async def _handle_request(self, request_id, job:Job, jobs:dict, send):
+        try:
+            await self.enqueue(job)
+            result = await self.result(job)
+            await send({'id': request_id, 'ok': True, 'result': result})
+        except (RequestError, ValueError, TypeError) as e:
+            await send({'id': request_id, 'ok': False, 'error': str(e)})
+        except ConnectionError:
+            # The client has gone, _handle_client cancels the rest of its jobs
+            pass
+        finally:
+            if jobs.get(request_id) is job:
+                del jobs[request_id]
+
+    async def _handle_client(self, reader, writer):
+        jobs = {}
+        tasks = set()
+        in_flight = asyncio.Semaphore(self.client_requests)
+
+        async def send(message:dict):
+            writer.write((json.dumps(message) + '\n').encode())
+            await writer.drain()
+
+        def finished(task):
+            tasks.discard(task)
+            in_flight.release()
+
+        self._clients[asyncio.current_task()] = writer
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('request must be a JSON object')
+                except ValueError as e:
+                    await send({'id': None, 'ok': False, 'error': f'Invalid request: {e}'})
+                    continue
+
+                if request.get('cmd') == 'cancel':
+                    job = jobs.get(request.get('target'))
+                    if job is None:
+                        await send({'id': request.get('id'), 'ok': False, 'error': f"No request to cancel: {request.get('target')}"})
+                    else:
+                        self.cancel(job)
+                        await send({'id': request.get('id'), 'ok': True, 'result': {'target': request.get('target')}})
+                    continue
+
+                # Stop reading from this client until one of its requests finishes
+                await in_flight.acquire()
+                request_id = request.get('id')
+                try:
+                    params = {key: value for key, value in request.items() if key not in ['id', 'cmd']}
+                    job = self.create_job(request.get('cmd'), params)
+                except (RequestError, ValueError, TypeError) as e:
+                    in_flight.release()
+                    await send({'id': request_id, 'ok': False, 'error': str(e)})
+                    continue
+                ### Registered before the job is queued so a cancel that follows straight after finds it
+                if request_id is not None:
+                    jobs[request_id] = job
+                task = asyncio.create_task(self._handle_request(request_id, job, jobs, send))
+                tasks.add(task)
+                task.add_done_callback(finished)
+        except ConnectionError:
+            pass
+        finally:
+            ### Also runs if the handler is cancelled, the CancelledError carries on after it
+            for job in list(jobs.values()):
+                self.cancel(job)
+            for task in list(tasks):
+                task.cancel()
+            writer.close()
+            del self._clients[asyncio.current_task()]
+
+
+async def main(args):
+    server = AnalysisServer(args.workers, args.tablebases, args.queue_size, args.client_requests, args.timeout)
+    await server.start(args.host, args.port, args.unix)
+    print(f"Listening on {args.unix or f'{args.host}:{args.port}'}")
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve engine analysis to multiple clients')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--workers', type=int, default=None, help='number of engine processes')
+    parser.add_argument('--tablebases', default=None, help='directory of endgame tables')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help='queued requests per worker')
+    parser.add_argument('--client-requests', type=int, default=DEFAULT_CLIENT_REQUESTS, help='requests in flight per connection')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='maximum seconds for any request')
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
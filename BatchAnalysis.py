@@ -0,0 +1,291 @@
+"""
+    Batch analysis of FEN/EPD positions across a pool of worker processes.
+
+    Each position is scored with its legal move count, check/checkmate/stalemate status and the
+    best move found by the search. Results are written as JSON lines as soon as they are ready (so
+    they may be out of order - each has the index of its input line). EPD bm (best move) and am
+    (avoid move) operations are checked against the best move, so a tactical test suite can be run
+    and its solve rate reported.
+
+    Usage:
+        python BatchAnalysis.py suite.epd --output results.jsonl --workers 4 --depth 3
+        cat positions.fen | python BatchAnalysis.py - --movetime 0.5
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import ChessEngine
+import Instrumentation
+from Notation import move_to_san, move_to_uci, parse_san
+from Search import Search
+from Tablebase import Tablebase
+
+DEFAULT_DEPTH = 3
+
+
+def parse_operations(text:str) -> dict:
+    """
+        Parses EPD operations e.g. 'bm Qxf7+; id "WAC.001";' -> {'bm': ['Qxf7+'], 'id': ['WAC.001']}
+    """
+    operations = {}
+    current = ''
+    in_quotes = False
+    for char in text + ';':
+        if char == '"':
+            in_quotes = not in_quotes
+            current += char
+        elif char == ';' and not in_quotes:
+            tokens = []
+            token = ''
+            quoted = False
+            for op_char in current.strip():
+                if op_char == '"':
+                    quoted = not quoted
+                elif op_char == ' ' and not quoted:
+                    if token:
+                        tokens.append(token)
+                    token = ''
+                else:
+                    token += op_char
+            if token:
+                tokens.append(token)
+            if tokens:
+                operations[tokens[0]] = tokens[1:]
+            current = ''
+        else:
+            current += char
+    return operations
+
+
+def parse_epd_line(line:str):
+    """
+        Splits a FEN or EPD line into (fen, operations). EPD lines don't have the move clocks, so
+        they are only included in the FEN if present.
+    """
+    fields = line.split()
+    if len(fields) < 4:
+        raise ValueError(f'Invalid FEN/EPD: {line}')
+    fen_fields = fields[:4]
+    rest = fields[4:]
+    if len(rest) >= 2 and rest[0].isdigit() and rest[1].isdigit():
+        fen_fields += rest[:2]
+        rest = rest[2:]
+    return ' '.join(fen_fields), parse_operations(' '.join(rest))
+
+
+def _parse_moves(gs, sans:list, move_list:list, invalid_moves:list) -> list:
+    """
+        Parses a list of SAN moves, adding any that aren't legal in the position to invalid_moves
+    """
+    moves = []
+    for san in sans:
+        try:
+            moves.append(parse_san(gs, san, move_list))
+        except ValueError:
+            invalid_moves.append(san)
+    return moves
+
+
+def analyse_position(search:Search, line:str, depth=DEFAULT_DEPTH, movetime=None) -> dict:
+    """
+        Analyses a single FEN/EPD line using GameState for move generation and check detection
+    """
+    start = time.perf_counter()
+    fen, operations = parse_epd_line(line)
+    position = ChessEngine.Position.from_fen(fen)
+    gs = ChessEngine.GameState(position)
+    opp_colour = 'b' if gs.whiteToMove else 'w'
+    move_list = gs.getMoveList()
+    in_check = gs.check_if_check(opp_colour, testingCheck=True)
+
+    result = {
+        'fen': fen,
+        'id': operations['id'][0] if operations.get('id') else None,
+        'legal_moves': len(move_list),
+        'check': in_check,
+        'checkmate': in_check and not move_list,
+        'stalemate': not in_check and not move_list,
+    }
+    if move_list:
+        search_result = search.search(position.copy(), depth=depth, movetime=movetime)
+        result.update({
+            'best_move': move_to_uci(search_result.move),
+            'best_move_san': move_to_san(gs, search_result.move, move_list),
+            'score': search_result.score,
+            'depth': search_result.depth,
+            'nodes': search_result.nodes,
+            'pv': [move_to_uci(move) for move in search_result.pv],
+        })
+
+        if 'bm' in operations or 'am' in operations:
+            ### A bad bm/am is reported alongside the search result rather than replacing it
+            invalid_moves = []
+            best_moves = _parse_moves(gs, operations.get('bm', []), move_list, invalid_moves)
+            avoid_moves = _parse_moves(gs, operations.get('am', []), move_list, invalid_moves)
+            # If none of the best moves could be read there is nothing to compare against
+            if best_moves or not operations.get('bm'):
+                solved = search_result.move not in avoid_moves
+                if best_moves:
+                    solved = solved and search_result.move in best_moves
+                result['solved'] = solved
+            if invalid_moves:
+                result['invalid_moves'] = invalid_moves
+
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def _analyse_line(search:Search, index:int, line:str, depth, movetime) -> dict:
+    try:
+        result = analyse_position(search, line, depth, movetime)
+    except Exception as e:
+        result = {'fen': line.strip(), 'error': f'{type(e).__name__}: {e}'}
+    result['index'] = index
+    return result
+
+
+def _worker(tasks, results, depth, movetime, tablebase_dir):
+    """
+        Worker process loop: reads (index, line) from tasks until it gets None
+    """
+    Instrumentation.worker_started()
+    search = Search(tablebase=Tablebase(tablebase_dir) if tablebase_dir else None)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            index, line = task
+            results.put(_analyse_line(search, index, line, depth, movetime))
+    finally:
+        Instrumentation.worker_finished()
+
+
+def _positions(lines):
+    """
+        Skips blank lines and comments, keeping the line number as the index
+    """
+    for index, line in enumerate(lines):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield index, line
+
+
+class Summary():
+    """
+        Running totals for the test suite report
+    """
+
+    def __init__(self) -> None:
+        self.positions = 0
+        self.errors = 0
+        self.tested = 0
+        self.solved = 0
+        self.invalid_moves = 0
+        self.seconds = 0.0
+        self.nodes = 0
+
+    def add(self, result:dict):
+        self.positions += 1
+        if 'error' in result:
+            self.errors += 1
+            return
+        self.seconds += result['seconds']
+        self.nodes += result.get('nodes', 0)
+        self.invalid_moves += len(result.get('invalid_moves', []))
+        if 'solved' in result:
+            self.tested += 1
+            self.solved += result['solved']
+
+    def as_dict(self) -> dict:
+        analysed = self.positions - self.errors
+        return {
+            'positions': self.positions,
+            'errors': self.errors,
+            'tested': self.tested,
+            'solved': self.solved,
+            'solve_rate': self.solved / self.tested if self.tested else None,
+            'invalid_moves': self.invalid_moves,
+            'mean_seconds': self.seconds / analysed if analysed else None,
+            'nodes': self.nodes,
+        }
+
+
+def run_batch(lines, output, workers=None, depth=DEFAULT_DEPTH, movetime=None, tablebase_dir=None, queue_size=None) -> dict:
+    """
+        Analyses every position in lines (any iterable of FEN/EPD strings, e.g. an open file) and
+        writes one JSON line per position to output. At most queue_size positions are in flight at
+        once so large inputs are streamed rather than read into memory.
+
+        With workers=0 everything runs in this process. Returns the summary.
+    """
+    summary = Summary()
+
+    def write(result):
+        summary.add(result)
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+
+    if workers == 0:
+        search = Search(tablebase=Tablebase(tablebase_dir) if tablebase_dir else None)
+        for index, line in _positions(lines):
+            write(_analyse_line(search, index, line, depth, movetime))
+        return summary.as_dict()
+
+    workers = workers or os.cpu_count() or 1
+    queue_size = queue_size or 2*workers
+    # Both queues are bounded, and no more than queue_size positions are handed out before a
+    # result is read back, so neither side can block the other
+    tasks = multiprocessing.Queue(queue_size)
+    results = multiprocessing.Queue(queue_size)
+    processes = [multiprocessing.Process(target=_worker, args=(tasks, results, depth, movetime, tablebase_dir), daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    try:
+        pending = 0
+        for task in _positions(lines):
+            if pending >= queue_size:
+                write(results.get())
+                pending -= 1
+            tasks.put(task)
+            pending += 1
+        while pending:
+            write(results.get())
+            pending -= 1
+    finally:
+        for _ in processes:
+            tasks.put(None)
+        for process in processes:
+            process.join()
+
+    return summary.as_dict()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyse FEN/EPD positions and report EPD test suite results')
+    parser.add_argument('input', help="FEN/EPD file, or - to read from stdin")
+    parser.add_argument('--output', default='-', help='JSON lines output file (default stdout)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (0 runs in this process)')
+    parser.add_argument('--depth', type=int, default=None, help=f'search depth (default {DEFAULT_DEPTH} unless --movetime is given)')
+    parser.add_argument('--movetime', type=float, default=None, help='seconds to search each position')
+    parser.add_argument('--tablebases', default=None, help='directory of endgame tables')
+    parser.add_argument('--queue-size', type=int, default=None, help='maximum positions in flight')
+    args = parser.parse_args()
+
+    depth = args.depth if args.depth is not None or args.movetime is not None else DEFAULT_DEPTH
+    infile = sys.stdin if args.input == '-' else open(args.input)
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        summary = run_batch(infile, outfile, args.workers, depth, args.movetime, args.tablebases, args.queue_size)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+    print(json.dumps(summary), file=sys.stderr)
@@ -2,39 +2,243 @@
     This class is responsible for storing all information about the current state of the chess game. It will also be responsible for 
     determining the valid moves at the current state and keeping a log of previous moves.
 """
-import numpy as np
-from copy import deepcopy
-
-class GameState():
-
-    def __init__(self) -> None:
+import os
+import struct
+from collections import OrderedDict
+
+# Piece codes used when packing a board into bytes, the index of each piece is its code
+PIECE_CODES = ['','wP','wN','wB','wR','wQ','wK','bP','bN','bB','bR','bQ','bK']
+PIECE_CODE_MAP = {piece: code for code, piece in enumerate(PIECE_CODES)}
+# board (64 bytes) | side to move + castling flags | en passant square | halfmove clock | fullmove number
+POSITION_STRUCT = struct.Struct('<64sBBHH')
+POSITION_KEY_SIZE = 66
+NO_EP_SQUARE = 255
+LEGAL_MOVE_CACHE_SIZE = 512
+CASTLE_MAP = {
+    (2, 0): {'rook_old':(0, 0),'rook_new':(3, 0)},
+    (6, 0): {'rook_old':(7, 0),'rook_new':(5, 0)},
+    (2, 7): {'rook_old':(0, 7),'rook_new':(3, 7)},
+    (6, 7): {'rook_old':(7, 7),'rook_new':(5, 7)},
+}
+# Moving from (or capturing on) these squares removes the castling right
+CASTLE_ROOK_SQUARES = {
+    (7, 0): 'blackCastleKS',
+    (0, 0): 'blackCastleQS',
+    (7, 7): 'whiteCastleKS',
+    (0, 7): 'whiteCastleQS',
+}
+
+class Position():
+    """
+        Compact position that only holds what is needed to generate moves. It has no GUI state so it is
+        cheap to copy, and packs into a fixed size bytes blob for hashing or sending to other processes.
+    """
+    __slots__ = ('board','whiteToMove','whiteCastleKS','whiteCastleQS','blackCastleKS','blackCastleQS',
+                 'epSquare','halfmoveClock','fullmoveNumber')
+
+    def __init__(self, board=None, whiteToMove=True, castling=(True,True,True,True), epSquare=None, halfmoveClock=0, fullmoveNumber=1) -> None:
         # The board is an 8x8 2d list. Each element is 2 characters.
         # The first character represents the colour of the piece: 'b' or 'w'
         # The second character represents the type of piece, 'K', 'Q', 'R', 'B', 'N' or 'P'
         # Empty squares on the chess
-        self.board = [
-            ["bR","bN","bB","bQ","bK","bB","bN","bR"],
-            ["bP" for i in range(8)],
-            ["" for i in range(8)],
-            ["" for i in range(8)],
-            ["" for i in range(8)],
-            ["" for i in range(8)],
-            ["wP" for i in range(8)],
-            ["wR","wN","wB","wQ","wK","wB","wN","wR"],
-        ]
-        self.whiteToMove = True
+        if board is None:
+            board = [
+                ["bR","bN","bB","bQ","bK","bB","bN","bR"],
+                ["bP" for i in range(8)],
+                ["" for i in range(8)],
+                ["" for i in range(8)],
+                ["" for i in range(8)],
+                ["" for i in range(8)],
+                ["wP" for i in range(8)],
+                ["wR","wN","wB","wQ","wK","wB","wN","wR"],
+            ]
+        self.board = board
+        self.whiteToMove = whiteToMove
+        self.whiteCastleKS, self.whiteCastleQS, self.blackCastleKS, self.blackCastleQS = castling
+        # x,y co-ords of the square a pawn can move to when capturing en passant
+        self.epSquare = epSquare
+        self.halfmoveClock = halfmoveClock
+        self.fullmoveNumber = fullmoveNumber
+
+    def copy(self):
+        position = Position.__new__(Position)
+        position.board = [col[:] for col in self.board]
+        position.whiteToMove = self.whiteToMove
+        position.whiteCastleKS = self.whiteCastleKS
+        position.whiteCastleQS = self.whiteCastleQS
+        position.blackCastleKS = self.blackCastleKS
+        position.blackCastleQS = self.blackCastleQS
+        position.epSquare = self.epSquare
+        position.halfmoveClock = self.halfmoveClock
+        position.fullmoveNumber = self.fullmoveNumber
+        return position
+
+    def to_bytes(self) -> bytes:
+        """
+            Packs the position into POSITION_STRUCT.size (70) bytes
+        """
+        board = bytes(PIECE_CODE_MAP[row] for col in self.board for row in col)
+        flags = (self.whiteToMove | self.whiteCastleKS << 1 | self.whiteCastleQS << 2
+                 | self.blackCastleKS << 3 | self.blackCastleQS << 4)
+        ep = self.epSquare[1]*8 + self.epSquare[0] if self.epSquare else NO_EP_SQUARE
+        return POSITION_STRUCT.pack(board, flags, ep, self.halfmoveClock, self.fullmoveNumber)
+
+    @classmethod
+    def from_bytes(cls, data:bytes):
+        board, flags, ep, halfmoveClock, fullmoveNumber = POSITION_STRUCT.unpack(data)
+        position = cls.__new__(cls)
+        position.board = [[PIECE_CODES[code] for code in board[y*8:y*8+8]] for y in range(8)]
+        position.whiteToMove = bool(flags & 1)
+        position.whiteCastleKS = bool(flags & 2)
+        position.whiteCastleQS = bool(flags & 4)
+        position.blackCastleKS = bool(flags & 8)
+        position.blackCastleQS = bool(flags & 16)
+        position.epSquare = None if ep == NO_EP_SQUARE else (ep % 8, ep // 8)
+        position.halfmoveClock = halfmoveClock
+        position.fullmoveNumber = fullmoveNumber
+        return position
+
+    @classmethod
+    def from_fen(cls, fen:str):
+        """
+            Creates a Position from a FEN record (see GameState.create_fen for the format).
+            The halfmove clock and full move number are optional so EPD positions can be loaded too.
+        """
+        fields = fen.split()
+        if len(fields) < 4:
+            raise ValueError(f'Invalid FEN: {fen}')
+        rows = fields[0].split('/')
+        if len(rows) != 8:
+            raise ValueError(f'Invalid FEN board: {fields[0]}')
+        board = []
+        for row in rows:
+            col = []
+            for char in row:
+                if char.isdigit():
+                    col += ['' for i in range(int(char))]
+                elif char.upper() in 'KQRBNP':
+                    col.append(f"{'w' if char.isupper() else 'b'}{char.upper()}")
+                else:
+                    raise ValueError(f'Invalid FEN piece: {char}')
+            if len(col) != 8:
+                raise ValueError(f'Invalid FEN row: {row}')
+            board.append(col)
+        if fields[1] not in ['w','b']:
+            raise ValueError(f'Invalid FEN side to move: {fields[1]}')
+        castling = tuple(char in fields[2] for char in 'KQkq')
+        epSquare = None
+        if fields[3] != '-':
+            epSquare = (ord(fields[3][0]) - ord('a'), 8 - int(fields[3][1]))
+        halfmoveClock = int(fields[4]) if len(fields) > 4 and fields[4].isdigit() else 0
+        fullmoveNumber = int(fields[5]) if len(fields) > 5 and fields[5].isdigit() else 1
+        return cls(board, fields[1] == 'w', castling, epSquare, halfmoveClock, fullmoveNumber)
+
+    def key(self) -> bytes:
+        """
+            Bytes that identify the position for hashing - the packed position without the clocks
+        """
+        return self.to_bytes()[:POSITION_KEY_SIZE]
+
+    def __reduce__(self):
+        # Pickle as the packed bytes so sending positions to worker processes is cheap
+        return (Position.from_bytes, (self.to_bytes(),))
+
+    def makeMove(self, old:tuple, new:tuple, promotion='Q'):
+        """
+            Moves a piece from old to new x,y co-ords, handling captures, en passant, castling and promotion
+            and updating castling rights, the en passant square, the clocks and the side to move.
+            The move is assumed to be legal.
+        """
+        board = self.board
+        old_x, old_y = old
+        new_x, new_y = new
+        piece = board[old_y][old_x]
+        captured = board[new_y][new_x]
+        board[old_y][old_x] = ''
+        board[new_y][new_x] = piece
+
+        if piece[1] == 'P':
+            ### Pawn moving diagonally to an empty square is capturing en passant
+            if new_x != old_x and not captured:
+                board[old_y][new_x] = ''
+            if new_y in [0, 7]:
+                board[new_y][new_x] = f'{piece[0]}{promotion}'
+            self.epSquare = (old_x, (old_y + new_y) // 2) if abs(new_y - old_y) == 2 else None
+        else:
+            self.epSquare = None
+
+        ## If king moves, no longer able to castle. Moving 2 squares is castling so the rook moves too
+        if piece[1] == 'K':
+            if piece[0] == 'w':
+                self.whiteCastleKS = self.whiteCastleQS = False
+            else:
+                self.blackCastleKS = self.blackCastleQS = False
+            if abs(new_x - old_x) == 2:
+                rook_old_x, rook_old_y = CASTLE_MAP[new]['rook_old']
+                rook_new_x, rook_new_y = CASTLE_MAP[new]['rook_new']
+                board[rook_new_y][rook_new_x] = board[rook_old_y][rook_old_x]
+                board[rook_old_y][rook_old_x] = ''
+        if old in CASTLE_ROOK_SQUARES:
+            setattr(self, CASTLE_ROOK_SQUARES[old], False)
+        if new in CASTLE_ROOK_SQUARES:
+            setattr(self, CASTLE_ROOK_SQUARES[new], False)
+
+        self.halfmoveClock = 0 if captured or piece[1] == 'P' else self.halfmoveClock + 1
+        if not self.whiteToMove:
+            self.fullmoveNumber += 1
+        self.whiteToMove = not self.whiteToMove
+        return captured
+
+    def makeNullMove(self):
+        """
+            Passes the turn to the other side without moving a piece. Only used by the search.
+        """
+        self.epSquare = None
+        self.halfmoveClock += 1
+        if not self.whiteToMove:
+            self.fullmoveNumber += 1
+        self.whiteToMove = not self.whiteToMove
+
+
+def _position_property(name:str):
+    """
+        Exposes an attribute of GameState.position as if it was stored on the GameState
+    """
+    def getter(self):
+        return getattr(self.position, name)
+
+    def setter(self, value):
+        setattr(self.position, name, value)
+
+    return property(getter, setter)
+
+
+class GameState():
+
+    board = _position_property('board')
+    whiteToMove = _position_property('whiteToMove')
+    whiteCastleKS = _position_property('whiteCastleKS')
+    whiteCastleQS = _position_property('whiteCastleQS')
+    blackCastleKS = _position_property('blackCastleKS')
+    blackCastleQS = _position_property('blackCastleQS')
+    epSquare = _position_property('epSquare')
+
+    def __init__(self, position=None) -> None:
+        # Everything needed to generate moves is kept in a Position, the rest is game and GUI state
+        self.position = position if position is not None else Position()
         self.moveLog = []
         self.moveIndex = -1
         self.whiteCheck = False
         self.blackCheck = False
         self.legalMovesInCheck = []
-        self.checkMate = False
-        self.whiteCastleKS = True
-        self.whiteCastleQS = True
-        self.blackCastleKS = True
-        self.blackCastleQS = True
+        # None until checkMate is first read for the current position, see updateCheck
+        self._checkMate = False
         self.allBlackLegal = []
         self.allWhiteLegal = []
+        # Position after each move in moveLog (index 0 is the starting position) for undo/redo
+        self.positionLog = [self.position.copy()]
+        # Legal moves of recently seen positions, keyed by Position.key(), least recently used dropped first
+        self.legalMoveCache = OrderedDict()
 
     def update_moveLog(self,old,new):
         """
@@ -58,6 +262,51 @@ class GameState():
         self.moveLog.append(move_str)
         self.moveIndex += 1
 
+    def makeMove(self,old:tuple,new:tuple,promotion='Q'):
+        """
+            Plays a move: adds it to the move log, updates the position (including castling, en passant
+            and promotion) and then works out if the opponent is now in check.
+        """
+        colour = self.board[old[1]][old[0]][0]
+        self.update_moveLog(old=old,new=new)
+        self.position.makeMove(old,new,promotion)
+        ### Remove any positions after the current move, same as the moveLog
+        self.positionLog = self.positionLog[:self.moveIndex+1]
+        self.positionLog.append(self.position.copy())
+        self.updateCheck(colour)
+
+    def promote(self,square:tuple,piece:str):
+        """
+            Changes the piece a pawn promoted to on the last move (makeMove promotes to a queen)
+        """
+        x, y = square
+        self.board[y][x] = piece
+        self.positionLog[self.moveIndex+1] = self.position.copy()
+        self.updateCheck(piece[0])
+
+    def updateCheck(self,colour:str):
+        """
+            Works out if the player that has just moved (colour) has put the opponent in check.
+            Checkmate is only worked out if checkMate is read, using the cached legal moves.
+        """
+        self._checkMate = None
+        ## Sets whiteCheck/blackCheck
+        self.check_if_check(colour)
+
+    @property
+    def checkMate(self) -> bool:
+        """
+            True if the side to move is in check and has no legal moves
+        """
+        if self._checkMate is None:
+            in_check = self.whiteCheck if self.whiteToMove else self.blackCheck
+            self._checkMate = in_check and not self.getLegalMoves()
+        return self._checkMate
+
+    @checkMate.setter
+    def checkMate(self,value:bool):
+        self._checkMate = value
+
     def undoMove(self):
         """
             Used to go back in the moveLog and retrace steps
@@ -65,42 +314,42 @@ class GameState():
         if self.moveIndex < 0:
             pass
         else:
-            move = self.moveLog[self.moveIndex]
             self.moveIndex -= 1
-            ### Converts StockFish move format to x,y vector
-            old_x = ord(move[2]) - 97
-            old_y = int(move[3])*-1+8
-            new_x = ord(move[0]) - 97
-            new_y = int(move[1])*-1+8
-            self.board[new_y][new_x] = self.board[old_y][old_x]
-            if self.board[old_y][old_x]:
-                try:
-                    piece = move.split('_')[1]
-                except IndexError:
-                    piece = ''
-            else:
-                piece = ''
-            self.board[old_y][old_x] = piece
+            self.position = self.positionLog[self.moveIndex+1].copy()
+            self.updateCheck('b' if self.whiteToMove else 'w')
 
     def redoMove(self):
         """
             Used to redo moves in the moveLog
         """
-        moveIndex = self.moveIndex + 1
-
-        try:
-            move = self.moveLog[moveIndex]
+        if self.moveIndex + 1 < len(self.moveLog):
             self.moveIndex += 1
-            ### Converts StockFish move format to x,y vector
-            new_x = ord(move[2]) - 97
-            new_y = int(move[3])*-1+8
-            old_x = ord(move[0]) - 97
-            old_y = int(move[1])*-1+8
-            self.board[new_y][new_x] = self.board[old_y][old_x]
-            self.board[old_y][old_x] = ''
-        except IndexError:
-            pass # No moves to redo as moveIndex is the last element of the list
+            self.position = self.positionLog[self.moveIndex+1].copy()
+            self.updateCheck('b' if self.whiteToMove else 'w')
+        # Otherwise no moves to redo as moveIndex is the last element of the list
+
+    def getLegalMoves(self) -> dict:
+        """
+            Cached version of getValidMoves. Legal moves are only calculated the first time a position is
+            seen, so clicking pieces or going back and forward through the moves doesn't recalculate them.
+            The returned dict is shared with the cache and shouldn't be changed.
+        """
+        key = self.position.key()
+        legal_moves = self.legalMoveCache.get(key)
+        if legal_moves is None:
+            legal_moves = self.getValidMoves()
+            self.legalMoveCache[key] = legal_moves
+            if len(self.legalMoveCache) > LEGAL_MOVE_CACHE_SIZE:
+                self.legalMoveCache.popitem(last=False)
+        else:
+            self.legalMoveCache.move_to_end(key)
+        return legal_moves
 
+    def legalMovesFor(self,square:tuple) -> list:
+        """
+            Legal squares for the piece on square (x,y), empty if it can't move or it isn't its turn
+        """
+        return self.getLegalMoves().get(square, [])
 
     def wP(self,selected_piece,board, check_check=False, mult=-1):
         mult = -1
@@ -160,22 +409,11 @@ class GameState():
         """
             En passant is a special move that gives pawns the option to capture a pawn which has just passed it.
         """
-        # Calculate the moveLog values to check if last move was pawn passing
-        old_left_x = new_left_x = chr(ord('`')+selected_piece[1])
-        old_right_x = new_right_x = chr(ord('`')+selected_piece[1]+2)
-
-        new_left_y = (selected_piece[2]*-1)+8
-        left_y_var = 2 if selected_piece[0][0] == 'w' else -2
-        old_left_y = new_left_y + left_y_var
-        new_right_y = (selected_piece[2]*-1)+8
-        right_y_var = 2 if selected_piece[0][0] == 'w' else -2
-        old_right_y = new_right_y + right_y_var
-
+        # The en passant square is set when the last move was a pawn moving 2 squares
         legal_moves = []
-        if self.moveLog[-1] == f"{old_left_x}{old_left_y}{new_left_x}{new_left_y}":
-            legal_moves = (selected_piece[1]-1,selected_piece[2]+(1*mult))
-        elif self.moveLog[-1] == f"{old_right_x}{old_right_y}{new_right_x}{new_right_y}":
-            legal_moves = (selected_piece[1]+1,selected_piece[2]+(1*mult))
+        ep_square = self.epSquare
+        if ep_square and ep_square[1] == selected_piece[2]+(1*mult) and abs(ep_square[0] - selected_piece[1]) == 1:
+            legal_moves = ep_square
         return legal_moves
 
     def wN(self,selected_piece,board,check_check=False):
@@ -364,7 +602,8 @@ class GameState():
         king_y = selected_piece[2]
         if (self.blackCastleKS and selected_piece[0][0] == 'b') or (self.whiteCastleKS and selected_piece[0][0] == 'w'):
             ks_adj_x = selected_piece[1] + 1
-            if (ks_adj_x, king_y) in legal_squares:
+            # The adjacent square has to be empty as well as safe, the king can't castle by capturing on it
+            if (ks_adj_x, king_y) in legal_squares and self.board[king_y][ks_adj_x] == '':
                 ks_castle_x = selected_piece[1] + 2
                 if (ks_castle_x, king_y) not in opp_colour_moves and self.board[king_y][ks_castle_x] == '':
                     if self.board[king_y][7] == f'{selected_piece[0][0]}R':
@@ -372,7 +611,7 @@ class GameState():
 
         if (self.blackCastleQS and selected_piece[0][0] == 'b') or (self.whiteCastleQS and selected_piece[0][0] == 'w'):
             qs_adj_x = selected_piece[1] - 1
-            if (qs_adj_x, king_y) in legal_squares:
+            if (qs_adj_x, king_y) in legal_squares and self.board[king_y][qs_adj_x] == '':
                 qs_castle_x = selected_piece[1] - 2
                 if (qs_castle_x, king_y) not in opp_colour_moves and self.board[king_y][qs_castle_x] == '' and self.board[king_y][qs_castle_x - 1] == '':
                     castle_sqs.append((qs_castle_x,king_y))
@@ -383,15 +622,9 @@ class GameState():
         """
             Function to handle correctly castling
         """
-        castle_map = {
-            (2, 0): {'rook_old':(0, 0),'rook_new':(3, 0)},
-            (6, 0): {'rook_old':(7, 0),'rook_new':(5, 0)},
-            (2, 7): {'rook_old':(0, 7),'rook_new':(3, 7)},
-            (6, 7): {'rook_old':(7, 7),'rook_new':(5, 7)}, 
-        }
         colour = 'b' if drop_pos[1] == 0 else 'w'
-        rook_old_x, rook_old_y = castle_map[drop_pos]['rook_old']
-        rook_new_x, rook_new_y = castle_map[drop_pos]['rook_new']
+        rook_old_x, rook_old_y = CASTLE_MAP[drop_pos]['rook_old']
+        rook_new_x, rook_new_y = CASTLE_MAP[drop_pos]['rook_new']
         self.board[rook_new_y][rook_new_x] = f'{colour}R'
         self.board[rook_old_y][rook_old_x] = ''
 
@@ -508,6 +741,7 @@ class GameState():
         """
         blocking_squares = []
         king_col = 'b' if king == 'w' else 'w'
+
         king_y,king_x = self.kingCoords(king_col,self.board)
         ### Get King's moves so we can add to list later
         opp_king_str = f'{king_col}K'
@@ -571,8 +805,11 @@ class GameState():
             old_x,old_y = key
             for move in value:
                 new_x,new_y = move
-                board = deepcopy(self.board)
+                board = [col[:] for col in self.board]
                 piece = board[old_y][old_x]
+                ### A pawn moving diagonally to an empty square is capturing en passant, so the captured pawn is removed too
+                if piece[1] == 'P' and new_x != old_x and not board[new_y][new_x]:
+                    board[old_y][new_x] = ''
                 board[old_y][old_x] = ''
                 board[new_y][new_x] = piece
                 in_check = self.check_if_check(board=board,testingCheck=True,colour=colour)
@@ -584,15 +821,58 @@ class GameState():
 
         return safe_moves
 
+    def getValidMoves(self) -> dict:
+        """
+            Gets every legal move for the side to move.
+
+            Uses the same piece logic as the GUI, then removes any move that leaves the king in check.
+            Returns a dict of {(x,y): [(new_x,new_y), ...]} keyed by the square of the moving piece.
+        """
+        colour = 'w' if self.whiteToMove else 'b'
+        opp_colour = 'b' if self.whiteToMove else 'w'
+        in_check = self.check_if_check(opp_colour,testingCheck=True)
+
+        legal_moves = {}
+        for y,col in enumerate(self.board):
+            for x,row in enumerate(col):
+                if row and row[0] == colour:
+                    func = getattr(self,row)
+                    selected_piece = (row, x, y)
+                    if row[1] == 'K':
+                        moves = func(selected_piece,check=False,board=self.board)
+                        if in_check: # Can't castle out of check
+                            moves = [move for move in moves if abs(move[0] - x) < 2]
+                    else:
+                        moves = func(selected_piece,board=self.board)
+                    if moves:
+                        legal_moves[(x,y)] = moves
+
+        return self.testCheckMoves(legal_moves,colour=opp_colour)
+
+    def getMoveList(self) -> list:
+        """
+            Gets every legal move for the side to move as a list of (old, new, promotion) tuples.
+            Pawns reaching the last rank get one move for each piece they can promote to, otherwise
+            promotion is ''.
+        """
+        move_list = []
+        for old,moves in self.getValidMoves().items():
+            piece = self.board[old[1]][old[0]]
+            for new in moves:
+                if piece[1] == 'P' and new[1] in [0, 7]:
+                    move_list += [(old, new, promotion) for promotion in ['Q','R','B','N']]
+                else:
+                    move_list.append((old, new, ''))
+        return move_list
+
     def kingCoords(self,colour,board):
         """
             Function to find x,y coords of king
         """
         king = f"{colour}K"
-        array = np.array(board)
-        king_xy = list(zip(*np.where(array == king)))
-        y,x = king_xy[0]
-        return y,x
+        for y,col in enumerate(board):
+            if king in col:
+                return y,col.index(king)
 
     def create_fen(self):
         """
@@ -640,9 +920,19 @@ class GameState():
             castle_str = '-'
         fen += f' {castle_str}'
         # en passant square
-        fen += ' -'
+        if self.epSquare:
+            ep_x, ep_y = self.epSquare
+            fen += f" {chr(ord('a')+ep_x)}{8-ep_y}"
+        else:
+            fen += ' -'
         # halfmove clock
-        fen += ' 0'
+        fen += f' {self.position.halfmoveClock}'
         # Number of full moves.
-        full_moves = str(len(self.moveLog) // 2)
-        fen += f' {full_moves}'
\ No newline at end of file
+        fen += f' {self.position.fullmoveNumber}'
+        return fen
+
+
+### Opt-in profiling of the hot paths, see Instrumentation.py
+if os.environ.get('CHESS_ENGINE_PROFILE'):
+    import Instrumentation
+    Instrumentation.enable_from_env()
@@ -13,16 +13,18 @@ CIRC_RADIUS = SQ_SIZE * 0.2
 OCC_CIRC_RADIUS = SQ_SIZE / 2
 OCC_CIRC_INNER_RADIUS = round(OCC_CIRC_RADIUS * 0.78)
 MAX_FPS = 60 # Use for animations later on
+# Scaled sprites keyed by (piece, size), filled in by getImage
 IMAGES = {}
 PROMOTION_SQ_SIZE = SQ_SIZE
 
 """
-Initialise global dictionary of images.
+Loads and scales a piece sprite the first time it is drawn at a size, then reuses it from the global dictionary of images.
 """
-def loadImages():
-    pieces = ['wP','wN','wB','wR','wQ','wK','bP','bN','bB','bR','bQ','bK']
-    for piece in pieces:
-        IMAGES[piece] = p.transform.scale(p.image.load(f'sprites/{piece}.png'), (SQ_SIZE, SQ_SIZE))
+def getImage(piece, size=SQ_SIZE):
+    key = (piece, size)
+    if key not in IMAGES:
+        IMAGES[key] = p.transform.scale(p.image.load(f'sprites/{piece}.png'), (size, size))
+    return IMAGES[key]
 
 """
 The main driver for our code. This will handle user inputs and update graphics
@@ -42,7 +44,7 @@ def get_square_under_mouse(board):
 def drag(screen, board, selected_piece):
     if selected_piece and selected_piece[0]:
         piece, x, y = get_square_under_mouse(board)
-        s1 = p.transform.scale(p.image.load(f'sprites/{selected_piece[0]}.png'), (SQ_SIZE, SQ_SIZE))
+        s1 = getImage(selected_piece[0])
         pos = p.Vector2(p.mouse.get_pos())
         screen.blit(s1, s1.get_rect(center=pos))
         return (x, y)
@@ -54,7 +56,6 @@ def main():
     screen.fill(p.Color("white"))
     p.display.set_caption("Chess Engine")
     gs = ChessEngine.GameState()
-    loadImages()
 
     selected_piece = None
     drop_pos = None
@@ -78,35 +79,12 @@ def main():
                     if selected_piece[0] and ((selected_piece[0][0] == 'w' and gs.whiteToMove) or (selected_piece[0][0] == 'b' and not gs.whiteToMove)):
 
                         lastPiece = selected_piece[0]
-                        # Move calculations are labelled the same as pieces (e.g. wP move logic is function wP)
-                        func_name = getattr(gs, selected_piece[0])
-                        # Different logic for if a piece is a king as need to remove squares that make the king in check
-                        if selected_piece[0][1] == 'K':
-                            legal_squares = func_name(selected_piece,check=False,board=gs.board)
-                        else:
-                            legal_squares = func_name(selected_piece,board=gs.board)
+                        ### Legal moves for the whole position are calculated once per ply and cached on the GameState,
+                        ### so this is a dictionary lookup. A set makes checking the drop square quick too.
+                        legal_squares = set(gs.legalMovesFor((x, y)))
 
-                        if ((piece[0] == 'w' and gs.whiteCheck) or (piece[0] == 'b' and gs.blackCheck)):
-                            if gs.checkMate:
-                                print("Checkmate.")
-                                legal_squares = []
-                            else:
-
-                                ### Only return legal squares for piece if it is in legalMovesInCheck list
-                                if (x, y) in gs.legalMovesInCheck.keys():
-                                    legal_squares = list(set(legal_squares) & set(gs.legalMovesInCheck[(x, y)]))
-                                else:
-                                    legal_squares = []
-                        else:
-                            ### For each legal square, make sure that it doesn't put the player in check
-                            legal_squares_dict = {}
-                            legal_squares_dict[(x, y)] = legal_squares
-                            opp_colour = 'w' if piece[0] == 'b' else 'b'
-                            safe_squares = gs.testCheckMoves(legal_squares_dict,colour=opp_colour)
-                            if not safe_squares:
-                                legal_squares = []
-                            else:
-                                legal_squares = list(set(safe_squares[(x, y)]) & set(legal_squares))
+                        if ((piece[0] == 'w' and gs.whiteCheck) or (piece[0] == 'b' and gs.blackCheck)) and gs.checkMate:
+                            print("Checkmate.")
 
                         gs.board[y][x] = ''
                     else:
@@ -128,19 +106,14 @@ def main():
                             3: 'N'
                         }
                         new_piece = piece_map[y_difference]
-                        gs.board[promotion_y][promotion_x] = f"{promotion_clr}{new_piece}"
+                        ## Swaps the queen for the chosen piece and recalculates check
+                        gs.promote((promotion_x, promotion_y), f"{promotion_clr}{new_piece}")
 
                         promotion_select = False
                         promotion_x = ''
                         promotion_y = ''
                         promotion_clr = ''
 
-                        ## Calculate if in check - attackingPieces has a list of piece,x,y coords of all pieces getting player in check
-                        colour = promotion_clr
-                        attackingPieces = gs.check_if_check(colour)
-                        if attackingPieces:
-                            gs.checkLegalMoves(attackingPieces,colour)
-
                 elif drop_pos:
                     # Unable to move to that position as not in chessboard
                     if (drop_pos[0]==None) or (drop_pos not in legal_squares) or (og_x == x and og_y == y):
@@ -150,45 +123,14 @@ def main():
                         drop_pos = None
 
                     else:
-                        # Add move to log
-                        gs.update_moveLog(old=(og_x,og_y),new=(x,y))
-
-                        # Remove piece from old position on board once moved
                         piece, old_x, old_y = selected_piece
-                        gs.board[old_y][old_x] = ''
                         new_x, new_y = drop_pos
-                        en_passant = True if gs.board[new_y][new_x] == '' and new_x!=old_x and piece[1]=='P' else False
-                        gs.board[new_y][new_x] = piece
+                        # Put the dragged piece back on its old square so the move can be played from there
+                        gs.board[old_y][old_x] = piece
+                        ## Plays the move - handles the move log, castling, en passant, promoting to a queen,
+                        ## calculating check and changing the side to move
+                        gs.makeMove((old_x, old_y), drop_pos)
                         legal_squares = []
-                        ### Captured piece is on a different square
-
-                        if en_passant:
-                            captured_x, captured_y = gs.capture_ep(drop_pos)
-                            gs.board[captured_y][captured_x] = ''
-                            
-                        ## Logic for castling.
-                        ## If king moves, no longer able to castle
-                        if piece[1] == 'K':
-                            if piece[0] == 'w':
-                                gs.whiteCastleKS = False
-                                gs.whiteCastleQS = False
-                            else:
-                                gs.blackCastleKS = False
-                                gs.blackCastleQS = False
-                            # Player is castling if abs value is 2, calling function to move rook over king
-                            if abs(new_x - old_x) == 2:
-                                gs.moveCastling(drop_pos)
-
-                        ## Logic for removing ability to check if rook moves
-                        if piece[1] == 'R':
-                            castle_positions = {
-                                (7, 0): 'blackCastleKS',
-                                (0, 0): 'blackCastleQS',
-                                (7, 7): 'whiteCastleKS',
-                                (0, 7): 'whiteCastleQS',
-                            }
-                            if (old_x, old_y) in castle_positions:
-                                setattr(gs, castle_positions[(old_x, old_y)], False)
 
                         ## Logic for promoting a pawn when it reaches the end of the board
                         if piece[1] == 'P' and new_y in [0, 7]:
@@ -197,14 +139,6 @@ def main():
                             promotion_y = new_y
                             promotion_clr = piece[0]
 
-                        ## Calculate if in check - attackingPieces has a list of piece,x,y coords of all pieces getting player in check
-                        colour = piece[0]
-                        attackingPieces = gs.check_if_check(colour)
-                        if attackingPieces:
-                            gs.checkLegalMoves(attackingPieces,colour)
-
-                        gs.whiteToMove = not gs.whiteToMove
-
                 selected_piece = None
                 drop_pos = None
 
@@ -257,7 +191,7 @@ def drawPieces(screen, board):
         for c in range(DIMENSION):
             piece = board[r][c]
             if piece: # Not an empty square
-                screen.blit(IMAGES[piece], p.Rect(c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE))
+                screen.blit(getImage(piece), p.Rect(c*SQ_SIZE, r*SQ_SIZE, SQ_SIZE, SQ_SIZE))
 
 """
     Draw the promotion box when player is promoting a pawn
@@ -272,7 +206,7 @@ def drawPromotion(screen,drop_pos):
         y_coord = y + (c *colour_mult)
         p.draw.rect(screen, colour, p.Rect(x*PROMOTION_SQ_SIZE-1,y_coord*PROMOTION_SQ_SIZE,PROMOTION_SQ_SIZE+2,PROMOTION_SQ_SIZE))
         piece = f"{piece_colour}{piece_list[c]}"
-        screen.blit(IMAGES[piece], p.Rect(x*PROMOTION_SQ_SIZE-1,y_coord*PROMOTION_SQ_SIZE,PROMOTION_SQ_SIZE+2,PROMOTION_SQ_SIZE))
+        screen.blit(getImage(piece, PROMOTION_SQ_SIZE), p.Rect(x*PROMOTION_SQ_SIZE-1,y_coord*PROMOTION_SQ_SIZE,PROMOTION_SQ_SIZE+2,PROMOTION_SQ_SIZE))
         
     return True
 
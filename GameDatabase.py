@@ -0,0 +1,473 @@
+"""
+    On-disk game database with a position index, for finding games by position and opening explorer statistics.
+
+    Games are appended to a game file (.cgd) and never rewritten, so a game's offset in the file is
+    its id. Moves are stored as 2 bytes each rather than as text.
+
+    Game file layout (little-endian):
+        magic b'CEGD' | version u8
+        then one record per game:
+            result u8 | tags length u16 | move count u16 | tags (JSON) | moves (u16 each)
+        so a game can have at most 65535 bytes of tags and 65535 moves.
+
+    Every position reached in each game is replayed and keyed with the Polyglot key, and the
+    index file (.cgi next to the game file) holds one entry per (position, game):
+        magic b'CEGI' | version u8 | game file bytes indexed u64 | entry count u64
+        entries of key u64 | next move u16 | result u8 | game offset u64
+
+    Entries are sorted, so all entries for a position are next to each other and grouped by the move
+    played next and the result. The index is memory-mapped, and the number of games for each move
+    and result is found by binary search, so explorer lookups don't depend on how many games
+    reach the position. New games are not visible until update_index() merges them in.
+
+    Usage:
+        python GameDatabase.py import games.cgd games.pgn
+        python GameDatabase.py explore games.cgd --moves e2e4 e7e5
+"""
+import argparse
+import heapq
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+from collections import namedtuple
+
+import ChessEngine
+from Notation import move_to_san, move_to_uci, parse_san, parse_uci
+from OpeningBook import polyglot_key
+
+GAMES_MAGIC = b'CEGD'
+INDEX_MAGIC = b'CEGI'
+VERSION = 1
+GAMES_HEADER_STRUCT = struct.Struct('<4sB')
+RECORD_STRUCT = struct.Struct('<BHH')
+INDEX_HEADER_STRUCT = struct.Struct('<4sBQQ')
+ENTRY_STRUCT = struct.Struct('<QHBQ')
+INDEX_EXTENSION = '.cgi'
+# Entries sorted in memory before being written to a temporary run file and merged
+DEFAULT_RUN_ENTRIES = 1000000
+WRITE_BATCH_ENTRIES = 10000
+
+RESULTS = ['*', '1-0', '0-1', '1/2-1/2']
+UNKNOWN, WHITE_WIN, BLACK_WIN, DRAW = range(4)
+PROMOTION_PIECES = ['', 'N', 'B', 'R', 'Q']
+# Next move for the last position of a game
+NO_MOVE = 0xFFFF
+# Largest tags length and move count that fit in a game record's u16 fields
+MAX_TAGS_LENGTH = 0xFFFF
+MAX_MOVES = 0xFFFF
+
+Game = namedtuple('Game', ['offset', 'result', 'tags', 'moves'])
+MoveStats = namedtuple('MoveStats', ['move', 'games', 'white_wins', 'draws', 'black_wins'])
+ExplorerResult = namedtuple('ExplorerResult', ['games', 'white_wins', 'draws', 'black_wins', 'moves'])
+
+
+def encode_move(move:tuple) -> int:
+    """
+        Packs an (old, new, promotion) move into 16 bits: from square | to square << 6 | promotion << 12
+    """
+    (old_x, old_y), (new_x, new_y), promotion = move
+    return (old_y*8 + old_x) | (new_y*8 + new_x) << 6 | PROMOTION_PIECES.index(promotion) << 12
+
+
+def decode_move(code:int) -> tuple:
+    old, new = code & 0x3F, (code >> 6) & 0x3F
+    return (old % 8, old // 8), (new % 8, new // 8), PROMOTION_PIECES[code >> 12]
+
+
+def start_position(tags:dict):
+    """
+        Games start from the standard position unless they have a FEN tag (as in PGN)
+    """
+    return ChessEngine.Position.from_fen(tags['FEN']) if 'FEN' in tags else ChessEngine.Position()
+
+
+def position_entries(game:Game) -> list:
+    """
+        Replays a game and returns an index entry for each distinct position in it. A position that
+        is repeated only counts once, with the move played the first time it was reached.
+    """
+    position = start_position(game.tags)
+    result = RESULTS.index(game.result)
+    seen = set()
+    entries = []
+    for move in game.moves + [None]:
+        key = polyglot_key(position)
+        if key not in seen:
+            seen.add(key)
+            entries.append((key, encode_move(move) if move else NO_MOVE, result, game.offset))
+        if move:
+            position.makeMove(move[0], move[1], move[2] or 'Q')
+    return entries
+
+
+def _write_entries(f, entries) -> int:
+    count = 0
+    batch = []
+    for entry in entries:
+        batch.append(ENTRY_STRUCT.pack(*entry))
+        if len(batch) >= WRITE_BATCH_ENTRIES:
+            f.write(b''.join(batch))
+            count += len(batch)
+            batch = []
+    f.write(b''.join(batch))
+    return count + len(batch)
+
+
+def _read_entries(f):
+    """
+        Yields entries from a sorted run file
+    """
+    f.seek(0)
+    while True:
+        data = f.read(ENTRY_STRUCT.size * WRITE_BATCH_ENTRIES)
+        if not data:
+            break
+        yield from ENTRY_STRUCT.iter_unpack(data)
+
+
+class GameDatabase():
+
+    def __init__(self, path:str) -> None:
+        """
+            Opens the game file at path and its index, creating empty ones if they don't exist
+        """
+        self.path = path
+        self.index_path = os.path.splitext(path)[0] + INDEX_EXTENSION
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(GAMES_HEADER_STRUCT.pack(GAMES_MAGIC, VERSION))
+        self._games = open(path, 'r+b')
+        magic, version = GAMES_HEADER_STRUCT.unpack(self._games.read(GAMES_HEADER_STRUCT.size))
+        if magic != GAMES_MAGIC or version != VERSION:
+            self._games.close()
+            raise ValueError(f'{path} is not a game database')
+        self._games.seek(0, os.SEEK_END)
+        self._index_file = None
+        self._mmap = None
+        self.indexed_size = GAMES_HEADER_STRUCT.size
+        self.size = 0
+        self._open_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def _open_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        self._index_file = open(self.index_path, 'rb')
+        self._mmap = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.indexed_size, self.size = INDEX_HEADER_STRUCT.unpack_from(self._mmap, 0)
+        if magic != INDEX_MAGIC or version != VERSION:
+            self._close_index()
+            raise ValueError(f'{self.index_path} is not a game database index')
+
+    def _close_index(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+
+    def close(self):
+        self._close_index()
+        self._games.close()
+
+    ### Game file
+
+    def add_game(self, moves:list, result='*', tags=None) -> int:
+        """
+            Appends a game and returns its offset, which is used as the game's id. Moves are
+            (old, new, promotion) tuples and are assumed to be legal from the start position.
+        """
+        tags = tags or {}
+        tag_data = json.dumps(tags, separators=(',', ':')).encode()
+        if len(tag_data) > MAX_TAGS_LENGTH:
+            raise ValueError(f'Game tags are {len(tag_data)} bytes, the most that can be stored is {MAX_TAGS_LENGTH}')
+        if len(moves) > MAX_MOVES:
+            raise ValueError(f'Game has {len(moves)} moves, the most that can be stored is {MAX_MOVES}')
+        self._games.seek(0, os.SEEK_END)
+        offset = self._games.tell()
+        self._games.write(RECORD_STRUCT.pack(RESULTS.index(result), len(tag_data), len(moves)))
+        self._games.write(tag_data)
+        self._games.write(struct.pack(f'<{len(moves)}H', *[encode_move(move) for move in moves]))
+        return offset
+
+    def _read_game(self, offset:int):
+        """
+            Reads the game at offset. Returns the Game and the offset of the next one.
+        """
+        self._games.seek(offset)
+        result, tags_length, move_count = RECORD_STRUCT.unpack(self._games.read(RECORD_STRUCT.size))
+        tags = json.loads(self._games.read(tags_length))
+        codes = struct.unpack(f'<{move_count}H', self._games.read(2*move_count))
+        game = Game(offset, RESULTS[result], tags, [decode_move(code) for code in codes])
+        return game, offset + RECORD_STRUCT.size + tags_length + 2*move_count
+
+    def read_game(self, offset:int) -> Game:
+        self._games.flush()
+        return self._read_game(offset)[0]
+
+    def iter_games(self, start=None):
+        """
+            Yields every game from the offset start (by default the first game) to the end of the file
+        """
+        self._games.flush()
+        end = self._games.seek(0, os.SEEK_END)
+        offset = start if start is not None else GAMES_HEADER_STRUCT.size
+        while offset < end:
+            game, offset = self._read_game(offset)
+            yield game
+
+    ### Index
+
+    def update_index(self, run_entries=DEFAULT_RUN_ENTRIES) -> int:
+        """
+            Replays the games added since the index was last updated and merges their positions into
+            the index. Large updates are sorted in runs of run_entries entries in temporary files so
+            memory use stays bounded. Returns the number of games indexed.
+        """
+        self._games.flush()
+        games_size = self._games.seek(0, os.SEEK_END)
+        if games_size == self.indexed_size:
+            return 0
+
+        runs = []
+        entries = []
+        new_games = 0
+        temp_path = self.index_path + '.tmp'
+        try:
+            for game in self.iter_games(self.indexed_size):
+                entries += position_entries(game)
+                new_games += 1
+                if len(entries) >= run_entries:
+                    entries.sort()
+                    run = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.path)))
+                    _write_entries(run, entries)
+                    runs.append(run)
+                    entries = []
+            entries.sort()
+
+            sources = [self._iter_index()] + [_read_entries(run) for run in runs] + [iter(entries)]
+            with open(temp_path, 'wb') as f:
+                f.write(INDEX_HEADER_STRUCT.pack(INDEX_MAGIC, VERSION, games_size, 0))
+                count = _write_entries(f, heapq.merge(*sources))
+                f.seek(0)
+                f.write(INDEX_HEADER_STRUCT.pack(INDEX_MAGIC, VERSION, games_size, count))
+            self._close_index()
+            os.replace(temp_path, self.index_path)
+        finally:
+            for run in runs:
+                run.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self._open_index()
+        return new_games
+
+    def _iter_index(self):
+        if self._mmap is None:
+            return
+        start = INDEX_HEADER_STRUCT.size
+        for offset in range(start, start + self.size*ENTRY_STRUCT.size, ENTRY_STRUCT.size*WRITE_BATCH_ENTRIES):
+            end = min(offset + ENTRY_STRUCT.size*WRITE_BATCH_ENTRIES, start + self.size*ENTRY_STRUCT.size)
+            yield from ENTRY_STRUCT.iter_unpack(self._mmap[offset:end])
+
+    def _entry_at(self, index:int) -> tuple:
+        return ENTRY_STRUCT.unpack_from(self._mmap, INDEX_HEADER_STRUCT.size + index*ENTRY_STRUCT.size)
+
+    def _lower_bound(self, target:tuple, lo=0) -> int:
+        """
+            Index of the first entry that is not less than target (which may be a prefix of an entry)
+        """
+        hi = self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry_at(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def explore(self, position) -> ExplorerResult:
+        """
+            Opening explorer statistics for a GameState or Position: how many indexed games reached
+            it, their results, and the same for each move played from it (most played first).
+        """
+        key = polyglot_key(position)
+        if self._mmap is None:
+            return ExplorerResult(0, 0, 0, 0, [])
+        index = self._lower_bound((key,))
+        end = self._lower_bound((key, NO_MOVE + 1), index)
+
+        totals = [0, 0, 0, 0]
+        moves = {}
+        ### Step through each (move, result) group, finding where it ends with a binary search
+        while index < end:
+            _, move, result, _ = self._entry_at(index)
+            group_end = self._lower_bound((key, move, result + 1), index)
+            count = group_end - index
+            totals[result] += count
+            if move != NO_MOVE:
+                counts = moves.setdefault(move, [0, 0, 0, 0])
+                counts[result] += count
+            index = group_end
+
+        move_stats = [MoveStats(decode_move(move), sum(counts), counts[WHITE_WIN], counts[DRAW], counts[BLACK_WIN])
+                      for move, counts in moves.items()]
+        move_stats.sort(key=lambda stats: stats.games, reverse=True)
+        return ExplorerResult(sum(totals), totals[WHITE_WIN], totals[DRAW], totals[BLACK_WIN], move_stats)
+
+    def find_games(self, position, limit=100) -> list:
+        """
+            Returns the offsets of up to limit indexed games that reached a GameState or Position
+        """
+        if self._mmap is None:
+            return []
+        key = polyglot_key(position)
+        index = self._lower_bound((key,))
+        offsets = []
+        while index < self.size and len(offsets) < limit:
+            entry_key, _, _, offset = self._entry_at(index)
+            if entry_key != key:
+                break
+            offsets.append(offset)
+            index += 1
+        return offsets
+
+
+### PGN import
+
+PGN_TAG = re.compile(r'\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]')
+PGN_TOKEN = re.compile(r'[{}();]|[^\s{}();]+')
+MOVE_NUMBER = re.compile(r'^\d+\.+')
+
+
+def _tag_result(tags:dict) -> str:
+    result = tags.get('Result', '*')
+    return result if result in RESULTS else '*'
+
+
+def read_pgn(lines):
+    """
+        Yields (tags, san moves, result) for each game in PGN text. A game ends at its result token,
+        or at the next tag section if it doesn't have one. Comments, variations, annotations and
+        move numbers are skipped.
+    """
+    tags = {}
+    moves = []
+    in_comment = False
+    variation_depth = 0
+    for line in lines:
+        line = line.strip()
+        if line.startswith('[') and not in_comment:
+            if moves:
+                yield tags, moves, _tag_result(tags)
+                tags, moves = {}, []
+            match = PGN_TAG.match(line)
+            if match:
+                tags[match.group(1)] = match.group(2)
+            continue
+        if line.startswith('%'):
+            continue
+        for token in PGN_TOKEN.findall(line):
+            if in_comment:
+                in_comment = token != '}'
+            elif token == '{':
+                in_comment = True
+            elif token == ';':
+                # Comment to the end of the line
+                break
+            elif token == '(':
+                variation_depth += 1
+            elif token == ')':
+                variation_depth = max(variation_depth - 1, 0)
+            elif variation_depth or token == '}' or token.startswith('$'):
+                continue
+            elif token in RESULTS:
+                yield tags, moves, token
+                tags, moves = {}, []
+            else:
+                token = MOVE_NUMBER.sub('', token)
+                if token:
+                    moves.append(token)
+    if tags or moves:
+        yield tags, moves, _tag_result(tags)
+
+
+def san_to_moves(san_moves:list, fen=None) -> list:
+    """
+        Converts SAN moves to (old, new, promotion) tuples, replaying them with a GameState so each
+        one is checked to be legal
+    """
+    position = ChessEngine.Position.from_fen(fen) if fen else ChessEngine.Position()
+    gs = ChessEngine.GameState(position)
+    moves = []
+    for san in san_moves:
+        move = parse_san(gs, san)
+        moves.append(move)
+        position.makeMove(move[0], move[1], move[2] or 'Q')
+    return moves
+
+
+def import_pgn(database:GameDatabase, lines) -> tuple:
+    """
+        Adds every game in PGN text to the database. Games with illegal moves, or too long to
+        store, are skipped.
+        Returns (games added, games skipped).
+    """
+    added = skipped = 0
+    for tags, san_moves, result in read_pgn(lines):
+        try:
+            moves = san_to_moves(san_moves, tags.get('FEN'))
+            database.add_game(moves, result, tags)
+        except ValueError:
+            skipped += 1
+            continue
+        added += 1
+    return added, skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and query a game database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='add the games in PGN files and update the index')
+    import_parser.add_argument('database', help='game database file (.cgd)')
+    import_parser.add_argument('pgn', nargs='+', help="PGN files, or - to read from stdin")
+    explore_parser = subparsers.add_parser('explore', help='show the moves played from a position')
+    explore_parser.add_argument('database', help='game database file (.cgd)')
+    explore_parser.add_argument('--fen', default=None, help='position to explore (default the start position)')
+    explore_parser.add_argument('--moves', nargs='*', default=[], help='UCI moves to play from the position first')
+    args = parser.parse_args()
+
+    with GameDatabase(args.database) as database:
+        if args.command == 'import':
+            for pgn in args.pgn:
+                infile = sys.stdin if pgn == '-' else open(pgn, errors='replace')
+                try:
+                    added, skipped = import_pgn(database, infile)
+                finally:
+                    if infile is not sys.stdin:
+                        infile.close()
+                print(f'{pgn}: added {added} games, skipped {skipped}')
+            print(f'Indexed {database.update_index()} games, {len(database)} positions in the index')
+        else:
+            position = ChessEngine.Position.from_fen(args.fen) if args.fen else ChessEngine.Position()
+            for uci in args.moves:
+                old, new, promotion = parse_uci(uci)
+                position.makeMove(old, new, promotion or 'Q')
+            gs = ChessEngine.GameState(position)
+            stats = database.explore(gs)
+            print(f'{stats.games} games: +{stats.white_wins} ={stats.draws} -{stats.black_wins}')
+            for move_stats in stats.moves:
+                print(f'{move_to_san(gs, move_stats.move, suffix=False):<8}{move_to_uci(move_stats.move):<7}'
+                      f'{move_stats.games:>8}  +{move_stats.white_wins} ={move_stats.draws} -{move_stats.black_wins}')
@@ -0,0 +1,212 @@
+"""
+    Opt-in instrumentation for the hot paths in GameState.
+
+    When enabled, the move generation methods on GameState are swapped for wrappers that count calls
+    and time spent. When disabled the original methods are put back, so there is no cost at all
+    unless it has been switched on.
+
+    Usage:
+        import Instrumentation
+        with Instrumentation.profiled():
+            gs.getValidMoves()
+        print(Instrumentation.report())
+
+    Setting the environment variable CHESS_ENGINE_PROFILE enables it as soon as ChessEngine is
+    imported. When the process exits a JSON snapshot is written to the path it is set to, or the
+    report is printed if it is set to 1.
+
+    Worker processes (BatchAnalysis, AnalysisServer) don't run exit handlers, so they call
+    worker_started and worker_finished instead. Each writes its own snapshot to the path with its
+    process id added, e.g. profile.json -> profile.1234.json.
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import ChessEngine
+
+PIECE_METHODS = ['wP','bP','wN','bN','wB','bB','wR','bR','wQ','bQ','wK','bK']
+HELPER_METHODS = ['move_pawn','en_passant','move_knight','move_bishop','move_rook','move_queen','move_king','filter_kingMoves','castling']
+CHECK_METHODS = ['check_all_moves','check_if_check','checkLegalMoves','testCheckMoves','getValidMoves','getLegalMoves','kingCoords']
+GAMESTATE_METHODS = PIECE_METHODS + HELPER_METHODS + CHECK_METHODS
+
+ENV_VAR = 'CHESS_ENGINE_PROFILE'
+
+# name: [calls, total seconds, own seconds (excluding other instrumented calls)]
+_stats = {}
+_originals = {}
+# Time spent in instrumented children, one entry per active call. Each thread has its own stack
+# (e.g. pondering runs a search in a background thread)
+_local = threading.local()
+_started = None
+
+
+def _child_time() -> list:
+    try:
+        return _local.child_time
+    except AttributeError:
+        _local.child_time = []
+        return _local.child_time
+
+
+def _wrap(name:str, func):
+    stat = _stats.setdefault(name, [0, 0.0, 0.0])
+    perf_counter = time.perf_counter
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        child_time = _child_time()
+        child_time.append(0.0)
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = perf_counter() - start
+            children = child_time.pop()
+            if child_time:
+                child_time[-1] += elapsed
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] += elapsed - children
+
+    return wrapper
+
+
+def enabled() -> bool:
+    return bool(_originals)
+
+
+def enable():
+    """
+        Replaces the GameState methods with timed wrappers
+    """
+    global _started
+    if enabled():
+        return
+    if _started is None:
+        _started = time.perf_counter()
+    for name in GAMESTATE_METHODS:
+        func = ChessEngine.GameState.__dict__[name]
+        _originals[name] = func
+        setattr(ChessEngine.GameState, name, _wrap(name, func))
+
+
+def disable():
+    """
+        Restores the original methods. Collected stats are kept until reset() is called.
+    """
+    for name, func in _originals.items():
+        setattr(ChessEngine.GameState, name, func)
+    _originals.clear()
+
+
+def reset():
+    global _started
+    # Zeroed in place as the wrappers hold on to their own stat lists
+    for stat in _stats.values():
+        stat[:] = [0, 0.0, 0.0]
+    _started = time.perf_counter() if enabled() else None
+
+
+@contextmanager
+def profiled():
+    """
+        Enables instrumentation for the duration of a with block
+    """
+    was_enabled = enabled()
+    enable()
+    try:
+        yield
+    finally:
+        if not was_enabled:
+            disable()
+
+
+def snapshot() -> dict:
+    """
+        Returns the stats collected so far in a JSON serialisable dict
+    """
+    wall_time = time.perf_counter() - _started if _started is not None else 0.0
+    functions = {}
+    for name, (calls, total, own) in _stats.items():
+        if calls:
+            functions[name] = {
+                'calls': calls,
+                'total_seconds': total,
+                'own_seconds': own,
+                'mean_us': total / calls * 1e6,
+            }
+    return {'wall_seconds': wall_time, 'functions': functions}
+
+
+def report() -> str:
+    """
+        Formats the stats as a table sorted by time spent in each function (excluding children)
+    """
+    data = snapshot()
+    lines = [
+        f"Profiled for {data['wall_seconds']:.3f}s",
+        f"{'function':<18}{'calls':>10}{'total s':>11}{'own s':>11}{'mean us':>11}",
+    ]
+    for name, stat in sorted(data['functions'].items(), key=lambda item: item[1]['own_seconds'], reverse=True):
+        lines.append(f"{name:<18}{stat['calls']:>10}{stat['total_seconds']:>11.4f}{stat['own_seconds']:>11.4f}{stat['mean_us']:>11.1f}")
+    return '\n'.join(lines)
+
+
+def dump_json(path:str):
+    with open(path, 'w') as f:
+        json.dump(snapshot(), f, indent=2)
+
+
+def _write_on_exit(target:str):
+    if target == '1':
+        print(report(), file=sys.stderr)
+    else:
+        dump_json(target)
+
+
+def process_path(path:str, pid=None) -> str:
+    """
+        Adds a process id to a snapshot path e.g. profile.json -> profile.1234.json
+    """
+    root, extension = os.path.splitext(path)
+    return f'{root}.{pid or os.getpid()}{extension}'
+
+
+def worker_started():
+    """
+        Called at the start of a worker process. If CHESS_ENGINE_PROFILE is set, instrumentation is
+        enabled and any stats inherited from the parent process are dropped.
+    """
+    if os.environ.get(ENV_VAR):
+        enable()
+        reset()
+
+
+def worker_finished():
+    """
+        Called when a worker process is about to exit, writes its stats if CHESS_ENGINE_PROFILE is set
+    """
+    target = os.environ.get(ENV_VAR)
+    if not target or not enabled():
+        return
+    if target == '1':
+        print(f'Process {os.getpid()}', file=sys.stderr)
+        _write_on_exit(target)
+    else:
+        _write_on_exit(process_path(target))
+
+
+def enable_from_env():
+    """
+        Enables instrumentation if CHESS_ENGINE_PROFILE is set and registers the report at exit
+    """
+    target = os.environ.get(ENV_VAR)
+    if target and not enabled():
+        enable()
+        atexit.register(_write_on_exit, target)
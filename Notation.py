@@ -0,0 +1,119 @@
+"""
+    Converts moves between the engine's x,y co-ords and text notation (UCI and SAN).
+
+    Moves are (old, new, promotion) tuples as returned by GameState.getMoveList, where old and new
+    are x,y co-ords and promotion is '' or one of 'Q','R','B','N'.
+"""
+import re
+
+import ChessEngine
+
+SAN_SUFFIXES = '+#!?'
+# piece, from file, from rank, target square, promotion. Long algebraic (Ng1-f3) also matches
+SAN_PATTERN = re.compile(r'^([KQRBN])?([a-h])?([1-8])?[x-]?([a-h][1-8])(?:=?([QRBN]))?$')
+
+
+def square_name(square:tuple) -> str:
+    x, y = square
+    return f"{chr(ord('a')+x)}{8-y}"
+
+
+def parse_square(name:str) -> tuple:
+    x = ord(name[0]) - ord('a')
+    y = 8 - int(name[1])
+    if not (-1 < x < 8 and -1 < y < 8):
+        raise ValueError(f'Invalid square: {name}')
+    return x, y
+
+
+def move_to_uci(move:tuple) -> str:
+    """
+        e.g. ((4,6),(4,4),'') -> 'e2e4' and ((0,1),(0,0),'Q') -> 'a7a8q'
+    """
+    old, new, promotion = move
+    return f'{square_name(old)}{square_name(new)}{promotion.lower()}'
+
+
+def parse_uci(text:str) -> tuple:
+    if len(text) not in [4, 5]:
+        raise ValueError(f'Invalid UCI move: {text}')
+    return parse_square(text[0:2]), parse_square(text[2:4]), text[4:].upper()
+
+
+def _san_without_suffix(board:list, move:tuple, move_list:list) -> str:
+    old, new, promotion = move
+    piece = board[old[1]][old[0]]
+    captured = board[new[1]][new[0]] != ''
+
+    if piece[1] == 'K' and abs(new[0] - old[0]) == 2:
+        return 'O-O' if new[0] == 6 else 'O-O-O'
+
+    if piece[1] == 'P':
+        # Pawns moving diagonally are always capturing (including en passant)
+        san = f"{square_name(old)[0]}x" if new[0] != old[0] else ''
+        san += square_name(new)
+        if promotion:
+            san += f'={promotion}'
+        return san
+
+    # Add the file, rank or both if another piece of the same type can move to the same square
+    others = [other_old for other_old, other_new, _ in move_list
+              if other_new == new and other_old != old and board[other_old[1]][other_old[0]] == piece]
+    disambiguation = ''
+    if others:
+        if all(other[0] != old[0] for other in others):
+            disambiguation = square_name(old)[0]
+        elif all(other[1] != old[1] for other in others):
+            disambiguation = square_name(old)[1]
+        else:
+            disambiguation = square_name(old)
+    return f"{piece[1]}{disambiguation}{'x' if captured else ''}{square_name(new)}"
+
+
+def move_to_san(gs, move:tuple, move_list=None, suffix=True) -> str:
+    """
+        Converts a legal move in the GameState's current position to standard algebraic notation.
+        The check (+) or checkmate (#) suffix is only worked out if suffix is True as it needs the
+        move to be played.
+    """
+    if move_list is None:
+        move_list = gs.getMoveList()
+    san = _san_without_suffix(gs.board, move, move_list)
+    if suffix:
+        colour = gs.board[move[0][1]][move[0][0]][0]
+        position = gs.position.copy()
+        position.makeMove(move[0], move[1], move[2] or 'Q')
+        after = ChessEngine.GameState(position)
+        if after.check_if_check(colour, testingCheck=True):
+            san += '#' if not after.getValidMoves() else '+'
+    return san
+
+
+def parse_san(gs, san:str, move_list=None) -> tuple:
+    """
+        Finds the legal move in the GameState's current position matching a SAN string.
+        Check/mate suffixes, annotations, a missing or extra 'x' or '=' and redundant
+        disambiguation (e.g. Ngf3 when only one knight can reach f3) are accepted.
+    """
+    if move_list is None:
+        move_list = gs.getMoveList()
+    board = gs.board
+    text = san.strip().rstrip(SAN_SUFFIXES).replace('0', 'O')
+    if text in ['O-O', 'O-O-O']:
+        new_x = 6 if text == 'O-O' else 2
+        matches = [move for move in move_list if board[move[0][1]][move[0][0]][1] == 'K'
+                   and abs(move[1][0] - move[0][0]) == 2 and move[1][0] == new_x]
+    else:
+        match = SAN_PATTERN.match(text)
+        if not match:
+            raise ValueError(f'Invalid SAN move: {san}')
+        piece_type, file, rank, target, promotion = match.groups()
+        new = parse_square(target)
+        matches = [move for move in move_list
+                   if move[1] == new and board[move[0][1]][move[0][0]][1] == (piece_type or 'P')
+                   and (file is None or square_name(move[0])[0] == file)
+                   and (rank is None or square_name(move[0])[1] == rank)
+                   and move[2] == (promotion or '')]
+    if len(matches) != 1:
+        raise ValueError(f'Illegal or ambiguous SAN move: {san}')
+    return matches[0]
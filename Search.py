@@ -0,0 +1,564 @@
+"""
+    Alpha-beta search for the engine.
+
+    The search copies and makes moves on Position objects and uses a single GameState for move
+    generation, so it plays by exactly the same rules as the GUI. Scores are in centipawns from the
+    side to move's point of view.
+"""
+import time
+from collections import namedtuple
+
+import ChessEngine
+from Tablebase import MAX_PIECES, castling_possible
+
+PIECE_VALUES = {'P':100,'N':320,'B':330,'R':500,'Q':900,'K':0}
+
+# Piece-square tables from white's point of view, indexed [y][x] (y=0 is the 8th rank like the board)
+PIECE_SQUARE_TABLES = {
+    'P': [
+        [  0,  0,  0,  0,  0,  0,  0,  0],
+        [ 50, 50, 50, 50, 50, 50, 50, 50],
+        [ 10, 10, 20, 30, 30, 20, 10, 10],
+        [  5,  5, 10, 25, 25, 10,  5,  5],
+        [  0,  0,  0, 20, 20,  0,  0,  0],
+        [  5, -5,-10,  0,  0,-10, -5,  5],
+        [  5, 10, 10,-20,-20, 10, 10,  5],
+        [  0,  0,  0,  0,  0,  0,  0,  0],
+    ],
+    'N': [
+        [-50,-40,-30,-30,-30,-30,-40,-50],
+        [-40,-20,  0,  0,  0,  0,-20,-40],
+        [-30,  0, 10, 15, 15, 10,  0,-30],
+        [-30,  5, 15, 20, 20, 15,  5,-30],
+        [-30,  0, 15, 20, 20, 15,  0,-30],
+        [-30,  5, 10, 15, 15, 10,  5,-30],
+        [-40,-20,  0,  5,  5,  0,-20,-40],
+        [-50,-40,-30,-30,-30,-30,-40,-50],
+    ],
+    'B': [
+        [-20,-10,-10,-10,-10,-10,-10,-20],
+        [-10,  0,  0,  0,  0,  0,  0,-10],
+        [-10,  0,  5, 10, 10,  5,  0,-10],
+        [-10,  5,  5, 10, 10,  5,  5,-10],
+        [-10,  0, 10, 10, 10, 10,  0,-10],
+        [-10, 10, 10, 10, 10, 10, 10,-10],
+        [-10,  5,  0,  0,  0,  0,  5,-10],
+        [-20,-10,-10,-10,-10,-10,-10,-20],
+    ],
+    'R': [
+        [  0,  0,  0,  0,  0,  0,  0,  0],
+        [  5, 10, 10, 10, 10, 10, 10,  5],
+        [ -5,  0,  0,  0,  0,  0,  0, -5],
+        [ -5,  0,  0,  0,  0,  0,  0, -5],
+        [ -5,  0,  0,  0,  0,  0,  0, -5],
+        [ -5,  0,  0,  0,  0,  0,  0, -5],
+        [ -5,  0,  0,  0,  0,  0,  0, -5],
+        [  0,  0,  0,  5,  5,  0,  0,  0],
+    ],
+    'Q': [
+        [-20,-10,-10, -5, -5,-10,-10,-20],
+        [-10,  0,  0,  0,  0,  0,  0,-10],
+        [-10,  0,  5,  5,  5,  5,  0,-10],
+        [ -5,  0,  5,  5,  5,  5,  0, -5],
+        [  0,  0,  5,  5,  5,  5,  0, -5],
+        [-10,  5,  5,  5,  5,  5,  0,-10],
+        [-10,  0,  5,  0,  0,  0,  0,-10],
+        [-20,-10,-10, -5, -5,-10,-10,-20],
+    ],
+    'K': [
+        [-30,-40,-40,-50,-50,-40,-40,-30],
+        [-30,-40,-40,-50,-50,-40,-40,-30],
+        [-30,-40,-40,-50,-50,-40,-40,-30],
+        [-30,-40,-40,-50,-50,-40,-40,-30],
+        [-20,-30,-30,-40,-40,-30,-30,-20],
+        [-10,-20,-20,-20,-20,-20,-20,-10],
+        [ 20, 20,  0,  0,  0,  0, 20, 20],
+        [ 20, 30, 10,  0,  0, 10, 30, 20],
+    ],
+}
+
+MATE_SCORE = 100000
+# Scores above this are mates, the difference from MATE_SCORE is the number of plies to mate
+MATE_THRESHOLD = MATE_SCORE - 1000
+INFINITY = 10**9
+MAX_DEPTH = 64
+QUIESCENCE_MAX_PLY = 8
+DEFAULT_TT_ENTRIES = 1000000
+
+# Transposition table entry types
+EXACT, LOWER_BOUND, UPPER_BOUND = 0, 1, 2
+
+# Pruning and extension techniques, each can be switched off through Search(options=...)
+DEFAULT_OPTIONS = {
+    'null_move': True,
+    'late_move_reductions': True,
+    'futility': True,
+    'reverse_futility': True,
+    'check_extensions': True,
+}
+# Null move search depth is reduced by this many plies (plus one more at higher depths)
+NULL_MOVE_REDUCTION = 2
+NULL_MOVE_MIN_DEPTH = 3
+# Moves ordered after this many are searched with reduced depth, reduced more after LMR_LATE_MOVES
+LMR_FULL_DEPTH_MOVES = 3
+LMR_LATE_MOVES = 6
+LMR_MIN_DEPTH = 3
+# Margins by remaining depth. A quiet move is skipped if the static evaluation plus the futility
+# margin can't reach alpha, and a node is cut if the evaluation minus the reverse futility margin
+# is still above beta.
+FUTILITY_MARGINS = [0, 200, 500]
+REVERSE_FUTILITY_MARGINS = [0, 150, 300, 500]
+
+SearchResult = namedtuple('SearchResult', ['move','score','depth','nodes','pv','seconds'])
+
+
+class SearchAborted(Exception):
+    """
+        Raised inside the search when it runs out of time or is asked to stop
+    """
+
+
+def evaluate(position) -> int:
+    """
+        Material and piece-square evaluation, from the side to move's point of view
+    """
+    score = 0
+    for y,col in enumerate(position.board):
+        for x,row in enumerate(col):
+            if row:
+                if row[0] == 'w':
+                    score += PIECE_VALUES[row[1]] + PIECE_SQUARE_TABLES[row[1]][y][x]
+                else:
+                    score -= PIECE_VALUES[row[1]] + PIECE_SQUARE_TABLES[row[1]][7-y][x]
+    return score if position.whiteToMove else -score
+
+
+def score_to_tt(score:int, ply:int) -> int:
+    """
+        Mate scores are stored relative to the position rather than the root
+    """
+    if score > MATE_THRESHOLD:
+        return score + ply
+    if score < -MATE_THRESHOLD:
+        return score - ply
+    return score
+
+
+def score_from_tt(score:int, ply:int) -> int:
+    if score > MATE_THRESHOLD:
+        return score - ply
+    if score < -MATE_THRESHOLD:
+        return score + ply
+    return score
+
+
+class TranspositionTable():
+    """
+        Stores (depth, score, entry type, best move) for searched positions, keyed by Position.key().
+        Once full the oldest entries are dropped first.
+    """
+
+    def __init__(self, max_entries=DEFAULT_TT_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self.table = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    def get(self, key:bytes):
+        return self.table.get(key)
+
+    def store(self, key:bytes, depth:int, score:int, flag:int, move):
+        entry = self.table.get(key)
+        if entry and entry[0] > depth and entry[3] is not None:
+            # Keep the deeper result but remember the newer best move
+            if move is not None:
+                self.table[key] = (entry[0], entry[1], entry[2], move)
+            return
+        if entry is None and len(self.table) >= self.max_entries:
+            del self.table[next(iter(self.table))]
+        self.table[key] = (depth, score, flag, move)
+
+    def clear(self):
+        self.table.clear()
+
+
+class Search():
+
+    def __init__(self, tt=None, tablebase=None, options=None) -> None:
+        # A single GameState is pointed at each position in turn to generate moves
+        self.gs = ChessEngine.GameState()
+        self.tt = tt if tt is not None else TranspositionTable()
+        self.tablebase = tablebase
+        options = options or {}
+        unknown = set(options) - set(DEFAULT_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown search options: {', '.join(sorted(unknown))}")
+        self.options = {**DEFAULT_OPTIONS, **options}
+        self.nodes = 0
+        # Set stop to True (e.g. from another thread) or give should_stop a callable to end the search early
+        self.stop = False
+        self.should_stop = None
+        self._deadline = None
+        self._node_limit = None
+        self._path = []
+        self._killers = {}
+        self._root_depth = 0
+
+    def legal_moves(self, position) -> list:
+        self.gs.position = position
+        return self.gs.getMoveList()
+
+    def in_check(self, position) -> bool:
+        self.gs.position = position
+        opp_colour = 'b' if position.whiteToMove else 'w'
+        return self.gs.check_if_check(opp_colour, testingCheck=True)
+
+    @staticmethod
+    def only_pawns(position) -> bool:
+        """
+            True if the side to move has nothing but a king and pawns. Zugzwang is common in these
+            positions so passing the turn isn't a safe guess at a lower bound.
+        """
+        colour = 'w' if position.whiteToMove else 'b'
+        return all(row[1] in 'KP' for col in position.board for row in col if row and row[0] == colour)
+
+    def capture_moves(self, position) -> list:
+        """
+            Legal captures (including promotions that capture) for quiescence search. Cheaper than
+            getMoveList as only moves onto an enemy piece are tested for leaving the king in check.
+        """
+        gs = self.gs
+        gs.position = position
+        board = position.board
+        colour = 'w' if position.whiteToMove else 'b'
+        opp_colour = 'b' if position.whiteToMove else 'w'
+        captures = []
+        for y,col in enumerate(board):
+            for x,row in enumerate(col):
+                if row and row[0] == colour:
+                    selected_piece = (row, x, y)
+                    if row[1] == 'K':
+                        moves = gs.move_king(selected_piece, board, False)
+                    else:
+                        moves = getattr(gs, row)(selected_piece, board=board)
+                    for new_x, new_y in moves:
+                        target = board[new_y][new_x]
+                        if not target or target[0] == colour:
+                            continue
+                        test_board = [c[:] for c in board]
+                        test_board[y][x] = ''
+                        test_board[new_y][new_x] = row
+                        if gs.check_if_check(opp_colour, board=test_board, testingCheck=True):
+                            continue
+                        promotion = 'Q' if row[1] == 'P' and new_y in [0, 7] else ''
+                        captures.append(((x, y), (new_x, new_y), promotion))
+        return captures
+
+    def _check_limits(self):
+        if self.stop:
+            raise SearchAborted()
+        if self._node_limit is not None and self.nodes >= self._node_limit:
+            raise SearchAborted()
+        if self._deadline is not None and time.perf_counter() >= self._deadline:
+            raise SearchAborted()
+        if self.should_stop is not None and self.should_stop():
+            raise SearchAborted()
+
+    def probe_tablebase(self, position, ply:int):
+        """
+            Returns a search score if the tablebase resolves the position, otherwise None
+        """
+        if self.tablebase is None or position.epSquare or castling_possible(position):
+            return None
+        if sum(1 for col in position.board for row in col if row) > MAX_PIECES:
+            return None
+        result = self.tablebase.probe(position.board, position.whiteToMove)
+        if result is None:
+            return None
+        if result.wdl > 0:
+            return MATE_SCORE - ply - result.dtm
+        if result.wdl < 0:
+            return -MATE_SCORE + ply + result.dtm
+        return 0
+
+    def order_moves(self, position, moves:list, tt_move, ply:int) -> list:
+        """
+            Hash move first, then captures (most valuable victim, least valuable attacker),
+            promotions, killer moves and finally the remaining quiet moves.
+        """
+        board = position.board
+        killers = self._killers.get(ply, [])
+
+        def move_score(move):
+            if move == tt_move:
+                return 1000000
+            old, new, promotion = move
+            target = board[new[1]][new[0]]
+            score = 0
+            if target:
+                score += 100000 + 10*PIECE_VALUES[target[1]] - PIECE_VALUES[board[old[1]][old[0]][1]]
+            if promotion:
+                score += 90000 + PIECE_VALUES[promotion]
+            if not score and move in killers:
+                score = 80000
+            return score
+
+        return sorted(moves, key=move_score, reverse=True)
+
+    def _store_killer(self, move, ply:int, position):
+        if position.board[move[1][1]][move[1][0]]:
+            return
+        killers = self._killers.setdefault(ply, [])
+        if move not in killers:
+            killers.insert(0, move)
+            del killers[2:]
+
+    def quiesce(self, position, alpha:int, beta:int, ply:int, qply=0) -> int:
+        self.nodes += 1
+        self._check_limits()
+        stand_pat = evaluate(position)
+        if stand_pat >= beta:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+        if qply >= QUIESCENCE_MAX_PLY:
+            return stand_pat
+
+        for move in self.order_moves(position, self.capture_moves(position), None, ply):
+            child = position.copy()
+            child.makeMove(move[0], move[1], move[2] or 'Q')
+            score = -self.quiesce(child, -beta, -alpha, ply + 1, qply + 1)
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def negamax(self, position, depth:int, alpha:int, beta:int, ply:int, in_check=None, allow_null=True) -> int:
+        self.nodes += 1
+        self._check_limits()
+        key = position.key()
+        options = self.options
+
+        if ply > 0:
+            # Repetition of a position already on the current line, or the fifty move rule
+            if key in self._path or position.halfmoveClock >= 100:
+                return 0
+            tablebase_score = self.probe_tablebase(position, ply)
+            if tablebase_score is not None:
+                return tablebase_score
+
+        original_alpha = alpha
+        tt_move = None
+        entry = self.tt.get(key)
+        if entry:
+            tt_depth, tt_score, tt_flag, tt_move = entry
+            if tt_depth >= depth and ply > 0:
+                tt_score = score_from_tt(tt_score, ply)
+                if tt_flag == EXACT:
+                    return tt_score
+                if tt_flag == LOWER_BOUND and tt_score >= beta:
+                    return tt_score
+                if tt_flag == UPPER_BOUND and tt_score <= alpha:
+                    return tt_score
+
+        if in_check is None:
+            in_check = self.in_check(position)
+        ## Search one ply deeper when in check so forcing lines aren't cut off at the horizon.
+        ## Limited to twice the root depth so a long series of checks can't run away.
+        if in_check and options['check_extensions'] and ply < 2*self._root_depth:
+            depth += 1
+
+        if depth <= 0:
+            return self.quiesce(position, alpha, beta, ply)
+
+        moves = self.legal_moves(position)
+        if not moves:
+            return -MATE_SCORE + ply if in_check else 0
+
+        static_eval = None
+        prune = ply > 0 and not in_check and abs(beta) < MATE_THRESHOLD
+        if prune:
+            static_eval = evaluate(position)
+
+            ### Reverse futility: far enough above beta that a quiet move is unlikely to drop below it
+            if (options['reverse_futility'] and depth < len(REVERSE_FUTILITY_MARGINS)
+                    and static_eval - REVERSE_FUTILITY_MARGINS[depth] >= beta):
+                return static_eval - REVERSE_FUTILITY_MARGINS[depth]
+
+        self._path.append(key)
+        try:
+            ### Null move: if passing the turn still fails high then a real move almost certainly would
+            if (prune and allow_null and options['null_move'] and depth >= NULL_MOVE_MIN_DEPTH
+                    and static_eval >= beta and not self.only_pawns(position)):
+                reduction = NULL_MOVE_REDUCTION + (1 if depth > 6 else 0)
+                child = position.copy()
+                child.makeNullMove()
+                score = -self.negamax(child, depth - 1 - reduction, -beta, -beta + 1, ply + 1, allow_null=False)
+                if score >= beta:
+                    # Mate scores found after a pass can't be trusted
+                    return beta if score > MATE_THRESHOLD else score
+
+            futile = (prune and options['futility'] and depth < len(FUTILITY_MARGINS)
+                      and static_eval + FUTILITY_MARGINS[depth] <= alpha)
+            board = position.board
+            killers = self._killers.get(ply, [])
+            best_score = -INFINITY
+            best_move = None
+            for rank, move in enumerate(self.order_moves(position, moves, tt_move, ply)):
+                quiet = not move[2] and not board[move[1][1]][move[1][0]] and move != tt_move and move not in killers
+                child = position.copy()
+                child.makeMove(move[0], move[1], move[2] or 'Q')
+                gives_check = None
+
+                ### Futility: a quiet move can't raise the score to alpha at the frontier, unless it gives check
+                if futile and quiet and best_move is not None:
+                    gives_check = self.in_check(child)
+                    if not gives_check:
+                        continue
+
+                ### Late move reductions: moves ordered late are searched shallower first, and
+                ### only searched to full depth if they turn out better than alpha
+                reduction = 0
+                if (options['late_move_reductions'] and quiet and not in_check
+                        and depth >= LMR_MIN_DEPTH and rank >= LMR_FULL_DEPTH_MOVES):
+                    if gives_check is None:
+                        gives_check = self.in_check(child)
+                    if not gives_check:
+                        reduction = 2 if rank >= LMR_LATE_MOVES and depth > 3 else 1
+
+                score = -self.negamax(child, depth - 1 - reduction, -beta, -alpha, ply + 1, gives_check)
+                if reduction and score > alpha:
+                    score = -self.negamax(child, depth - 1, -beta, -alpha, ply + 1, gives_check)
+                if score > best_score:
+                    best_score = score
+                    best_move = move
+                if score > alpha:
+                    alpha = score
+                if alpha >= beta:
+                    self._store_killer(move, ply, position)
+                    break
+        finally:
+            self._path.pop()
+
+        if best_score <= original_alpha:
+            flag = UPPER_BOUND
+        elif best_score >= beta:
+            flag = LOWER_BOUND
+        else:
+            flag = EXACT
+        self.tt.store(key, depth, score_to_tt(best_score, ply), flag, best_move)
+        return best_score
+
+    def principal_variation(self, position, max_length:int) -> list:
+        """
+            Follows the best moves stored in the transposition table
+        """
+        pv = []
+        seen = set()
+        position = position.copy()
+        while len(pv) < max_length:
+            key = position.key()
+            entry = self.tt.get(key)
+            if not entry or entry[3] is None or key in seen:
+                break
+            seen.add(key)
+            move = entry[3]
+            if move not in self.legal_moves(position):
+                break
+            pv.append(move)
+            position.makeMove(move[0], move[1], move[2] or 'Q')
+        return pv
+
+    def tablebase_move(self, position, moves:list):
+        """
+            Picks the best move using only the tablebase. Returns (move, score) or None if any move
+            leads to a position the tablebase can't resolve.
+        """
+        best = None
+        for move in moves:
+            child = position.copy()
+            child.makeMove(move[0], move[1], move[2] or 'Q')
+            if not self.legal_moves(child):
+                score = MATE_SCORE - 1 if self.in_check(child) else 0
+            else:
+                child_score = self.probe_tablebase(child, 1)
+                if child_score is None:
+                    return None
+                score = -child_score
+            if best is None or score > best[1]:
+                best = (move, score)
+        return best
+
+    def perft(self, position, depth:int, movetime=None) -> int:
+        """
+            Counts the leaf nodes of the legal move tree to the given depth. Used to check move generation.
+            Raises SearchAborted if it runs out of time or is asked to stop.
+        """
+        self.stop = False
+        self._node_limit = None
+        self._deadline = time.perf_counter() + movetime if movetime is not None else None
+        return self._perft(position, depth)
+
+    def _perft(self, position, depth:int) -> int:
+        self._check_limits()
+        if depth == 0:
+            return 1
+        moves = self.legal_moves(position)
+        if depth == 1:
+            return len(moves)
+        total = 0
+        for move in moves:
+            child = position.copy()
+            child.makeMove(move[0], move[1], move[2] or 'Q')
+            total += self._perft(child, depth - 1)
+        return total
+
+    def search(self, position, depth=None, movetime=None, nodes=None, on_iteration=None) -> SearchResult:
+        """
+            Iterative deepening search. Stops after depth plies, movetime seconds or nodes nodes
+            (whichever comes first), or when stop/should_stop is set. on_iteration is called with the
+            SearchResult of every completed depth.
+
+            The result of the deepest completed iteration is returned. If no limits are given the
+            search runs to depth 1.
+        """
+        start = time.perf_counter()
+        self.nodes = 0
+        self.stop = False
+        self._path = []
+        self._killers = {}
+        self._deadline = start + movetime if movetime is not None else None
+        self._node_limit = nodes
+        if depth is None:
+            depth = MAX_DEPTH if movetime is not None or nodes is not None else 1
+
+        moves = self.legal_moves(position)
+        if not moves:
+            score = -MATE_SCORE if self.in_check(position) else 0
+            return SearchResult(None, score, 0, 0, [], 0.0)
+
+        if self.probe_tablebase(position, 0) is not None:
+            tablebase_result = self.tablebase_move(position, moves)
+            if tablebase_result:
+                move, score = tablebase_result
+                return SearchResult(move, score, 0, len(moves), [move], time.perf_counter() - start)
+
+        result = SearchResult(moves[0], 0, 0, 0, [moves[0]], 0.0)
+        for current_depth in range(1, depth + 1):
+            self._root_depth = current_depth
+            try:
+                score = self.negamax(position, current_depth, -INFINITY, INFINITY, 0)
+            except SearchAborted:
+                break
+            pv = self.principal_variation(position, current_depth)
+            move = pv[0] if pv else result.move
+            result = SearchResult(move, score, current_depth, self.nodes, pv, time.perf_counter() - start)
+            if on_iteration is not None:
+                on_iteration(result)
+            # No point searching deeper once a forced mate has been found
+            if abs(score) > MATE_THRESHOLD:
+                break
+
+        return result._replace(nodes=self.nodes, seconds=time.perf_counter() - start)
@@ -0,0 +1,110 @@
+"""
+    Node count benchmark for the search pruning options.
+
+    Every position in a fixed set is searched to the same depth with each configuration of
+    Search options, starting from an empty transposition table each time. The node counts are
+    deterministic, so they can be compared between runs and between configurations to measure what
+    each technique saves.
+
+    Usage:
+        python SearchBenchmark.py --depth 4
+        python SearchBenchmark.py --depth 3 --configs all none no_null_move --json bench.json
+"""
+import argparse
+import json
+import time
+
+import ChessEngine
+from Notation import move_to_uci
+from Search import DEFAULT_OPTIONS, Search, TranspositionTable
+
+DEFAULT_DEPTH = 4
+BENCHMARK_TT_ENTRIES = 200000
+
+BENCHMARK_POSITIONS = [
+    # Opening
+    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+    'r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3',
+    # Middlegame
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+    'r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 8',
+    # Tactics
+    'r1b1kb1r/pppp1ppp/5q2/4n3/3KP3/2N3PN/PPP4P/R1BQ1B1R b kq - 0 1',
+    '6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1',
+    # Endgames, including pawn endings where null move pruning is switched off
+    '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+    '8/8/8/4k3/8/3K4/4P3/8 w - - 0 1',
+]
+
+
+def configurations() -> dict:
+    """
+        All techniques on, all off, and each one switched off on its own
+    """
+    configs = {
+        'all': {},
+        'none': {name: False for name in DEFAULT_OPTIONS},
+    }
+    for name in DEFAULT_OPTIONS:
+        configs[f'no_{name}'] = {name: False}
+    return configs
+
+
+def run_benchmark(options:dict, depth=DEFAULT_DEPTH, positions=BENCHMARK_POSITIONS) -> dict:
+    """
+        Searches every position with the given options. Returns the totals and a result per position.
+    """
+    results = []
+    total_nodes = 0
+    total_seconds = 0.0
+    for fen in positions:
+        search = Search(tt=TranspositionTable(BENCHMARK_TT_ENTRIES), options=options)
+        result = search.search(ChessEngine.Position.from_fen(fen), depth=depth)
+        total_nodes += result.nodes
+        total_seconds += result.seconds
+        results.append({
+            'fen': fen,
+            'move': move_to_uci(result.move) if result.move else None,
+            'score': result.score,
+            'nodes': result.nodes,
+            'seconds': result.seconds,
+        })
+    return {
+        'options': {**DEFAULT_OPTIONS, **options},
+        'nodes': total_nodes,
+        'seconds': total_seconds,
+        'nps': total_nodes / total_seconds if total_seconds else None,
+        'positions': results,
+    }
+
+
+def report(benchmarks:dict) -> str:
+    """
+        Formats the totals for each configuration, with nodes relative to searching with everything on
+    """
+    baseline = benchmarks.get('all')
+    lines = [f"{'config':<26}{'nodes':>10}{'vs all':>9}{'seconds':>10}{'nps':>9}"]
+    for name, bench in benchmarks.items():
+        relative = f"{bench['nodes'] / baseline['nodes']:.2f}x" if baseline and baseline['nodes'] else ''
+        lines.append(f"{name:<26}{bench['nodes']:>10}{relative:>9}{bench['seconds']:>10.2f}{bench['nps'] or 0:>9.0f}")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    configs = configurations()
+    parser = argparse.ArgumentParser(description='Compare search node counts with pruning techniques switched on and off')
+    parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH, help=f'search depth (default {DEFAULT_DEPTH})')
+    parser.add_argument('--configs', nargs='+', choices=list(configs), default=list(configs), help='configurations to run')
+    parser.add_argument('--json', default=None, help='also write the full results to this file')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    benchmarks = {}
+    for name in args.configs:
+        benchmarks[name] = run_benchmark(configs[name], args.depth)
+        print(f"{name}: {benchmarks[name]['nodes']} nodes", flush=True)
+    print(report(benchmarks))
+    print(f'Finished in {time.perf_counter() - start:.1f}s')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'depth': args.depth, 'benchmarks': benchmarks}, f, indent=2)
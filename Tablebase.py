@@ -0,0 +1,283 @@
+"""
+    Endgame tablebase probing for positions with a small number of pieces.
+
+    Tables are stored one file per material signature (e.g. KQvK.ctb) in the engine's own
+    compact format, which is written by TablebaseGenerator. Each file is memory-mapped and split
+    into zlib compressed blocks, only the blocks that are probed get decoded and the most recently
+    used ones are kept in an LRU cache.
+
+    File layout (little-endian):
+        magic b'CETB' | version u8 | piece count u8 | entries per block u32 | block count u32
+        pieces (2 bytes each, e.g. b'wKwQbK')
+        block offsets (block count + 1 u64s, relative to start of file)
+        compressed blocks
+
+    Every entry is an int16 scored from the side to move's point of view:
+        0       draw
+        n > 0   win, mate in n plies
+        n < 0   loss, mated in (-n - 1) plies. -1 means the side to move is already checkmated
+        INVALID illegal placement (overlapping pieces or side not to move is in check)
+
+    Positions are indexed by the square (y*8 + x) of each piece in table order, plus the side to
+    move. Castling and en passant are not represented, so positions where either is possible are
+    not probed.
+
+    Only tables in this format are read. Syzygy files (.rtbw/.rtbz) use a different, heavily
+    compressed encoding and are ignored when scanning a directory.
+"""
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections import OrderedDict, namedtuple
+
+from OpeningBook import en_passant_file
+
+MAGIC = b'CETB'
+VERSION = 1
+HEADER_STRUCT = struct.Struct('<4sBBII')
+OFFSET_STRUCT = struct.Struct('<Q')
+FILE_EXTENSION = '.ctb'
+# Largest tables TablebaseGenerator can produce. The format itself only limits the piece count to a
+# u8, but a table has 2*64**n entries so anything bigger isn't practical to build or store.
+MAX_PIECES = 3
+DEFAULT_BLOCK_ENTRIES = 4096
+DEFAULT_CACHE_BLOCKS = 256
+
+DRAW = 0
+INVALID = -32768
+PIECE_ORDER = 'KQRBNP'
+
+TablebaseResult = namedtuple('TablebaseResult', ['wdl', 'dtm'])
+
+
+def encode_result(wdl:int, dtm:int) -> int:
+    """
+        Converts a win/draw/loss and distance to mate (in plies) to the value stored in a table
+    """
+    if wdl > 0:
+        return dtm
+    if wdl < 0:
+        return -dtm - 1
+    return DRAW
+
+
+def decode_result(value:int):
+    """
+        Converts a stored table value back to a TablebaseResult. Returns None for invalid entries.
+    """
+    if value == INVALID:
+        return None
+    if value > 0:
+        return TablebaseResult(1, value)
+    if value < 0:
+        return TablebaseResult(-1, -value - 1)
+    return TablebaseResult(0, 0)
+
+
+def table_pieces(board:list) -> list:
+    """
+        Returns the pieces on the board in table order - white then black, each sorted K,Q,R,B,N,P
+    """
+    pieces = [row for col in board for row in col if row]
+    return sorted(pieces, key=lambda piece: (piece[0] != 'w', PIECE_ORDER.index(piece[1])))
+
+
+def material_signature(pieces:list) -> str:
+    """
+        Creates the table name for a list of pieces in table order e.g. ['wK','wQ','bK'] -> 'KQvK'
+    """
+    white = ''.join(piece[1] for piece in pieces if piece[0] == 'w')
+    black = ''.join(piece[1] for piece in pieces if piece[0] == 'b')
+    return f'{white}v{black}'
+
+
+def table_size(piece_count:int) -> int:
+    return 2 * 64**piece_count
+
+
+def position_index(squares:list, whiteToMove:bool) -> int:
+    """
+        Calculates the table index for the squares of each piece (in table order) and side to move
+    """
+    index = 0 if whiteToMove else 1
+    for sq in squares:
+        index = index*64 + sq
+    return index
+
+
+def index_squares(index:int, piece_count:int):
+    """
+        Inverse of position_index. Returns (squares, whiteToMove)
+    """
+    squares = []
+    for _ in range(piece_count):
+        squares.append(index % 64)
+        index //= 64
+    squares.reverse()
+    return squares, index == 0
+
+
+def board_squares(board:list, pieces:list) -> list:
+    """
+        Returns the square of each piece in table order. Identical pieces (e.g. two white rooks)
+        are listed in ascending square order so every placement has one canonical index.
+    """
+    squares_by_piece = {}
+    for y,col in enumerate(board):
+        for x,row in enumerate(col):
+            if row:
+                squares_by_piece.setdefault(row, []).append(y*8 + x)
+    for squares in squares_by_piece.values():
+        squares.sort()
+    return [squares_by_piece[piece].pop(0) for piece in pieces]
+
+
+def flip_board(board:list) -> list:
+    """
+        Mirrors the board vertically and swaps the colour of every piece
+    """
+    swap = {'w':'b', 'b':'w'}
+    return [[f'{swap[row[0]]}{row[1]}' if row else '' for row in col] for col in reversed(board)]
+
+
+def castling_possible(gs) -> bool:
+    """
+        Checks if a castling right can still be used, i.e. the king and rook are on their
+        starting squares.
+    """
+    castle_rooks = [
+        (gs.whiteCastleKS, 7, 'w', 7), (gs.whiteCastleQS, 7, 'w', 0),
+        (gs.blackCastleKS, 0, 'b', 7), (gs.blackCastleQS, 0, 'b', 0),
+    ]
+    for allowed, y, colour, rook_x in castle_rooks:
+        if allowed and gs.board[y][4] == f'{colour}K' and gs.board[y][rook_x] == f'{colour}R':
+            return True
+    return False
+
+
+class TableFile():
+    """
+        A single memory-mapped table file
+    """
+
+    def __init__(self, path:str) -> None:
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, piece_count, block_entries, block_count = HEADER_STRUCT.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f'{path} is not a version {VERSION} tablebase file')
+        self.piece_count = piece_count
+        self.block_entries = block_entries
+        self.block_count = block_count
+        pieces_start = HEADER_STRUCT.size
+        pieces = self._mmap[pieces_start:pieces_start + 2*piece_count].decode('ascii')
+        self.pieces = [pieces[i:i+2] for i in range(0, len(pieces), 2)]
+        self.offsets_start = pieces_start + 2*piece_count
+
+    def block_bounds(self, block:int):
+        start = OFFSET_STRUCT.unpack_from(self._mmap, self.offsets_start + block*OFFSET_STRUCT.size)[0]
+        end = OFFSET_STRUCT.unpack_from(self._mmap, self.offsets_start + (block+1)*OFFSET_STRUCT.size)[0]
+        return start, end
+
+    def read_block(self, block:int) -> array:
+        start, end = self.block_bounds(block)
+        values = array('h')
+        values.frombytes(zlib.decompress(self._mmap[start:end]))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class Tablebase():
+
+    def __init__(self, directory:str, cache_blocks=DEFAULT_CACHE_BLOCKS) -> None:
+        self.directory = directory
+        self.cache_blocks = cache_blocks
+        self._tables = {}
+        self._block_cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.available = set()
+        if os.path.isdir(directory):
+            for filename in os.listdir(directory):
+                name, extension = os.path.splitext(filename)
+                if extension == FILE_EXTENSION:
+                    self.available.add(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for table in self._tables.values():
+            table.close()
+        self._tables = {}
+        self._block_cache.clear()
+
+    def _table(self, signature:str):
+        if signature not in self._tables:
+            self._tables[signature] = TableFile(os.path.join(self.directory, signature + FILE_EXTENSION))
+        return self._tables[signature]
+
+    def _value(self, signature:str, index:int) -> int:
+        """
+            Reads a single entry, decoding (and caching) the block that contains it
+        """
+        table = self._table(signature)
+        block, offset = divmod(index, table.block_entries)
+        cache_key = (signature, block)
+        values = self._block_cache.get(cache_key)
+        if values is None:
+            self.misses += 1
+            values = table.read_block(block)
+            self._block_cache[cache_key] = values
+            if len(self._block_cache) > self.cache_blocks:
+                self._block_cache.popitem(last=False)
+        else:
+            self.hits += 1
+            self._block_cache.move_to_end(cache_key)
+        return values[offset]
+
+    def probe(self, board:list, whiteToMove:bool):
+        """
+            Looks up a board in the tablebase.
+
+            Returns a TablebaseResult (wdl, dtm) from the side to move's point of view, or None if
+            there are too many pieces or no table covers the material.
+        """
+        pieces = table_pieces(board)
+        if len(pieces) > MAX_PIECES:
+            return None
+        signature = material_signature(pieces)
+        if signature not in self.available:
+            # Tables are only stored with white as the stronger side, so mirror the position
+            board = flip_board(board)
+            whiteToMove = not whiteToMove
+            pieces = table_pieces(board)
+            signature = material_signature(pieces)
+            if signature not in self.available:
+                return None
+        index = position_index(board_squares(board, pieces), whiteToMove)
+        return decode_result(self._value(signature, index))
+
+    def probe_gamestate(self, gs, whiteToMove=None):
+        """
+            Probes the current board of a GameState. Positions where castling or en passant is still
+            possible can't be found in the tables so they return None.
+        """
+        if whiteToMove is None:
+            whiteToMove = gs.whiteToMove
+        if castling_possible(gs) or en_passant_file(gs) is not None:
+            return None
+        return self.probe(gs.board, whiteToMove)
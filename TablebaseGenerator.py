@@ -0,0 +1,327 @@
+"""
+    Builds endgame tables for Tablebase by retrograde analysis.
+
+    Every placement of the pieces (and side to move) is expanded once using GameState's own move
+    generation, so the tables follow exactly the same rules as the rest of the engine. Expansion is
+    split across a process pool, then the win/draw/loss and distance to mate of every position is
+    solved with NumPy, working backwards from checkmates one ply at a time. NumPy is only needed to
+    generate tables, Tablebase reads them without it.
+
+    The whole move graph of a table is held in memory while it is solved (every move as an int64
+    target, plus several temporaries of the same size per round), so generation is limited to
+    MAX_GENERATE_PIECES pieces. A 4 piece table has 2*64**4 positions and hundreds of millions of
+    moves, which would need tens of GB.
+
+    En passant isn't represented in the index, so the child of a double pawn push is looked up as
+    if no en passant capture were possible. That is only wrong when the other side has a pawn that
+    could capture, which needs at least two pawns and so can't happen within the 3 piece limit.
+
+    Usage:
+        python TablebaseGenerator.py KQvK KRvK KPvK --dir tablebases
+"""
+import argparse
+import os
+import zlib
+from array import array
+from multiprocessing import Pool
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError('TablebaseGenerator needs NumPy to solve tables, install it with: pip install numpy') from None
+
+import ChessEngine
+from Tablebase import (DEFAULT_BLOCK_ENTRIES, DRAW, FILE_EXTENSION, HEADER_STRUCT, INVALID, MAGIC,
+                       MAX_PIECES, OFFSET_STRUCT, PIECE_ORDER, VERSION, Tablebase, board_squares,
+                       encode_result, index_squares, material_signature, position_index, table_size)
+
+# Marks positions that haven't been solved yet. Anything still unknown when the search stops is a draw
+UNKNOWN = 32767
+DEFAULT_CHUNK_SIZE = 4096
+PROMOTION_PIECES = ['Q','R','B','N']
+# Largest table the in-memory solver can generate, see the module docstring
+MAX_GENERATE_PIECES = MAX_PIECES
+
+# Worker process state, set up once per process by _init_worker
+_worker = {}
+
+
+def pieces_from_signature(signature:str) -> list:
+    """
+        Converts a table name to a list of pieces in table order e.g. 'KQvK' -> ['wK','wQ','bK']
+    """
+    white, black = signature.upper().split('V')
+    pieces = [f'w{piece}' for piece in white] + [f'b{piece}' for piece in black]
+    return sorted(pieces, key=lambda piece: (piece[0] != 'w', PIECE_ORDER.index(piece[1])))
+
+
+def _strength(pieces:list, colour:str):
+    types = [piece[1] for piece in pieces if piece[0] == colour]
+    return len(types), sorted(-PIECE_ORDER.index(piece) for piece in types)
+
+
+def canonical_signature(pieces:list) -> str:
+    """
+        Tables are stored with white as the stronger side, returns the name the table is saved under
+    """
+    if _strength(pieces, 'b') > _strength(pieces, 'w'):
+        swap = {'w':'b', 'b':'w'}
+        pieces = pieces_from_signature(material_signature([f'{swap[piece[0]]}{piece[1]}' for piece in pieces]))
+    return material_signature(pieces)
+
+
+def insufficient_material(pieces:list) -> bool:
+    """
+        K v K, K+B v K and K+N v K can never be won so don't need a table
+    """
+    others = [piece for piece in pieces if piece[1] != 'K']
+    return not others or (len(others) == 1 and others[0][1] in ['B','N'])
+
+
+def child_signatures(pieces:list) -> set:
+    """
+        Gets the material that can be reached in one move from these pieces (captures and promotions)
+    """
+    signatures = set()
+    for i, piece in enumerate(pieces):
+        if piece[1] == 'K':
+            continue
+        captured = pieces[:i] + pieces[i+1:]
+        reachable = [captured]
+        for remaining in [pieces, captured]:
+            for j, pawn in enumerate(remaining):
+                if pawn[1] == 'P':
+                    for promotion in PROMOTION_PIECES:
+                        reachable.append(remaining[:j] + [f'{pawn[0]}{promotion}'] + remaining[j+1:])
+        for child in reachable:
+            if not insufficient_material(child):
+                signatures.add(canonical_signature(pieces_from_signature(material_signature(child))))
+    signatures.discard(material_signature(pieces))
+    return signatures
+
+
+def placement_board(squares:list, pieces:list):
+    """
+        Creates a board from the squares of each piece. Returns None for placements that are never
+        stored in a table: overlapping pieces, pawns on the first or last rank, and identical pieces
+        that aren't in ascending square order.
+    """
+    if len(set(squares)) != len(squares):
+        return None
+    board = [['' for i in range(8)] for j in range(8)]
+    for i, (piece, sq) in enumerate(zip(pieces, squares)):
+        y, x = divmod(sq, 8)
+        if piece[1] == 'P' and y in [0, 7]:
+            return None
+        if i > 0 and pieces[i-1] == piece and squares[i-1] > sq:
+            return None
+        board[y][x] = piece
+    return board
+
+
+def _init_worker(pieces:list, directory:str):
+    gs = ChessEngine.GameState()
+    # Tables don't include castling rights
+    gs.whiteCastleKS = gs.whiteCastleQS = gs.blackCastleKS = gs.blackCastleQS = False
+    _worker['gs'] = gs
+    _worker['pieces'] = pieces
+    _worker['tablebase'] = Tablebase(directory)
+
+
+def _child_value(board:list, whiteToMove:bool) -> int:
+    """
+        Looks up a position with different material (after a capture or promotion) in its own table
+    """
+    pieces = [row for col in board for row in col if row]
+    if insufficient_material(pieces):
+        return DRAW
+    result = _worker['tablebase'].probe(board, whiteToMove)
+    if result is None:
+        raise LookupError(f'Missing table for {canonical_signature(pieces_from_signature(material_signature(pieces)))}')
+    return encode_result(*result)
+
+
+def _expand_chunk(bounds:tuple):
+    """
+        Expands a range of table indexes.
+
+        Returns the first index of the chunk, the starting value of every position (INVALID, a mate or
+        stalemate, or UNKNOWN), the number of moves from each position, and one edge per move. An edge
+        is either the index of the next position in this table or -1 with the (final) value of a
+        position in another table.
+    """
+    start, end = bounds
+    gs = _worker['gs']
+    pieces = _worker['pieces']
+    values = np.full(end - start, UNKNOWN, dtype=np.int16)
+    edge_counts = np.zeros(end - start, dtype=np.int32)
+    edge_targets = array('q')
+    edge_values = array('h')
+
+    for i, index in enumerate(range(start, end)):
+        squares, whiteToMove = index_squares(index, len(pieces))
+        board = placement_board(squares, pieces)
+        if board is None:
+            values[i] = INVALID
+            continue
+        colour = 'w' if whiteToMove else 'b'
+        opp_colour = 'b' if whiteToMove else 'w'
+        gs.board = board
+        gs.whiteToMove = whiteToMove
+        # The side that isn't moving can't be in check
+        if gs.check_if_check(colour, testingCheck=True):
+            values[i] = INVALID
+            continue
+
+        legal_moves = gs.getValidMoves()
+        if not legal_moves:
+            in_check = gs.check_if_check(opp_colour, testingCheck=True)
+            values[i] = encode_result(-1, 0) if in_check else DRAW
+            continue
+
+        move_count = 0
+        for (old_x, old_y), moves in legal_moves.items():
+            piece = board[old_y][old_x]
+            for new_x, new_y in moves:
+                child = [row[:] for row in board]
+                child[old_y][old_x] = ''
+                captured = child[new_y][new_x]
+                child[new_y][new_x] = piece
+                if piece[1] == 'P' and new_y in [0, 7]:
+                    for promotion in PROMOTION_PIECES:
+                        child[new_y][new_x] = f'{piece[0]}{promotion}'
+                        edge_targets.append(-1)
+                        edge_values.append(_child_value(child, not whiteToMove))
+                        move_count += 1
+                elif captured:
+                    edge_targets.append(-1)
+                    edge_values.append(_child_value(child, not whiteToMove))
+                    move_count += 1
+                else:
+                    edge_targets.append(position_index(board_squares(child, pieces), not whiteToMove))
+                    edge_values.append(0)
+                    move_count += 1
+        edge_counts[i] = move_count
+
+    return start, values, edge_counts, np.frombuffer(edge_targets, dtype=np.int64), np.frombuffer(edge_values, dtype=np.int16)
+
+
+def expand(pieces:list, directory:str, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+        Expands every position of the table across a pool of worker processes
+    """
+    size = table_size(len(pieces))
+    chunks = [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+    values = np.empty(size, dtype=np.int16)
+    edge_counts = np.empty(size, dtype=np.int32)
+    edge_targets = []
+    edge_values = []
+    with Pool(processes, initializer=_init_worker, initargs=(pieces, directory)) as pool:
+        # imap keeps the chunks in order so the edges line up with the positions
+        for start, chunk_values, chunk_counts, chunk_targets, chunk_edge_values in pool.imap(_expand_chunk, chunks):
+            values[start:start + len(chunk_values)] = chunk_values
+            edge_counts[start:start + len(chunk_counts)] = chunk_counts
+            edge_targets.append(chunk_targets)
+            edge_values.append(chunk_edge_values)
+    return values, edge_counts, np.concatenate(edge_targets), np.concatenate(edge_values)
+
+
+def solve(values, edge_counts, edge_targets, edge_values):
+    """
+        Retrograde analysis. Round k finds every position that is won (k odd) or lost (k even) in exactly
+        k plies:
+            - a position is won in k if one of its moves leads to a position lost in k-1
+            - a position is lost in k if every move leads to a won position and the longest is won in k-1
+        Positions that are never resolved are draws.
+    """
+    values = values.copy()
+    edge_starts = np.concatenate(([0], np.cumsum(edge_counts, dtype=np.int64)[:-1]))
+    positions = np.flatnonzero(edge_counts > 0)
+    starts = edge_starts[positions]
+    internal = edge_targets >= 0
+    internal_targets = edge_targets[internal]
+    child_values = edge_values.copy()
+    external_values = edge_values[~internal].astype(np.int32)
+    longest_external = int(np.abs(external_values).max()) if len(external_values) else 0
+
+    k = 0
+    last_change = 0
+    while k <= last_change + 1 or k <= longest_external + 1:
+        k += 1
+        if not len(positions):
+            break
+        child_values[internal] = values[internal_targets]
+        children = child_values.astype(np.int32)
+        unsolved = values[positions] == UNKNOWN
+        if k % 2:
+            loss_dtm = np.where(children < 0, -children - 1, np.iinfo(np.int32).max)
+            shortest_loss = np.minimum.reduceat(loss_dtm, starts)
+            found = unsolved & (shortest_loss == k - 1)
+            values[positions[found]] = encode_result(1, k)
+        else:
+            winning = (children > 0) & (children != UNKNOWN)
+            all_winning = np.logical_and.reduceat(winning, starts)
+            longest_win = np.maximum.reduceat(np.where(winning, children, 0), starts)
+            found = unsolved & all_winning & (longest_win == k - 1)
+            values[positions[found]] = encode_result(-1, k)
+        if found.any():
+            last_change = k
+
+    values[values == UNKNOWN] = DRAW
+    return values
+
+
+def write_table(path:str, pieces:list, values, block_entries=DEFAULT_BLOCK_ENTRIES):
+    """
+        Streams the table to disk one compressed block at a time. The block offsets are filled in
+        at the end, and the file is only moved into place once complete.
+    """
+    block_count = (len(values) + block_entries - 1) // block_entries
+    header = HEADER_STRUCT.pack(MAGIC, VERSION, len(pieces), block_entries, block_count) + ''.join(pieces).encode('ascii')
+    tmp_path = path + '.tmp'
+    offsets = []
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(bytes(OFFSET_STRUCT.size * (block_count + 1)))
+        for start in range(0, len(values), block_entries):
+            offsets.append(f.tell())
+            f.write(zlib.compress(values[start:start + block_entries].astype('<i2').tobytes(), 9))
+        offsets.append(f.tell())
+        f.seek(len(header))
+        f.write(b''.join(OFFSET_STRUCT.pack(offset) for offset in offsets))
+    os.replace(tmp_path, path)
+
+
+def generate(signature:str, directory:str, processes=None, chunk_size=DEFAULT_CHUNK_SIZE, verbose=False) -> str:
+    """
+        Generates the table for a material signature (e.g. 'KQvK'), first generating any tables it
+        depends on for captures and promotions. Returns the path of the table.
+    """
+    pieces = pieces_from_signature(signature)
+    if len(pieces) > MAX_GENERATE_PIECES:
+        raise ValueError(f'{signature} has {len(pieces)} pieces, only tables of up to {MAX_GENERATE_PIECES} can be generated')
+    signature = canonical_signature(pieces)
+    pieces = pieces_from_signature(signature)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, signature + FILE_EXTENSION)
+    if os.path.exists(path):
+        return path
+
+    for child in sorted(child_signatures(pieces)):
+        generate(child, directory, processes, chunk_size, verbose)
+
+    if verbose:
+        print(f'Generating {signature}')
+    values = solve(*expand(pieces, directory, processes, chunk_size))
+    write_table(path, pieces, values)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate endgame tables by retrograde analysis')
+    parser.add_argument('signatures', nargs='+', help='material to generate e.g. KQvK')
+    parser.add_argument('--dir', default='tablebases', help='directory to write tables to')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+    for signature in args.signatures:
+        print(generate(signature, args.dir, args.processes, verbose=True))
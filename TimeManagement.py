@@ -0,0 +1,212 @@
+"""
+    Time management and pondering for timed games.
+
+    Each move gets a soft and a hard time limit from the clock (wtime/btime/winc/binc/movestogo, as
+    in UCI but in seconds). The search runs until the hard limit at most, but once an iteration
+    finishes it only starts the next one if there is enough of the soft limit left. The soft limit is
+    stretched when the best move keeps changing between iterations and shrunk when it is stable.
+
+    TimedPlayer adds pondering: after playing a move it searches the position after the reply it
+    expects in a background thread while the opponent thinks. If the opponent plays that reply (a
+    ponder hit) the same search carries on with the clock started, so the iterations it has already
+    finished are kept and the time spent pondering counts towards the soft limit. Otherwise the
+    ponder search is stopped and a new search is started. Both use the same transposition table.
+
+    Usage:
+        player = TimedPlayer(Search())
+        result = player.go(position, wtime=60, btime=60, winc=1, binc=1)
+        player.ponder(position_after_our_move, result)
+        ...
+        result = player.opponent_moved(reply, position_after_reply, wtime=..., btime=...)
+"""
+import threading
+import time
+
+from Search import MAX_DEPTH, Search
+
+# Seconds kept back on every move for communication and move making
+DEFAULT_MOVE_OVERHEAD = 0.05
+# Number of moves the remaining time is shared between when movestogo isn't given
+DEFAULT_MOVES_TO_GO = 30
+MAX_MOVES_TO_GO = 50
+# Share of the increment added to each move's time
+INCREMENT_USAGE = 0.8
+# The hard limit is this many times the soft limit, but never more than this share of the clock
+HARD_LIMIT_FACTOR = 4.0
+MAX_TIME_FRACTION = 0.5
+# Iterations take longer each depth, so don't start another one once this share of the soft limit is used
+NEXT_ITERATION_FRACTION = 0.6
+# Soft limit scaling by best move stability
+BEST_MOVE_CHANGE_SCALE = 1.6
+STABLE_ITERATION_SCALE = 0.85
+MIN_STABILITY_SCALE = 0.5
+
+
+def allocate_time(time_left:float, increment=0.0, movestogo=None, move_overhead=DEFAULT_MOVE_OVERHEAD) -> tuple:
+    """
+        Returns (soft limit, hard limit) in seconds for the side to move's next move
+    """
+    available = max(time_left - move_overhead, 0.0)
+    moves = min(movestogo, MAX_MOVES_TO_GO) if movestogo else DEFAULT_MOVES_TO_GO
+    soft = available / moves + increment * INCREMENT_USAGE
+    hard = min(soft * HARD_LIMIT_FACTOR, available * MAX_TIME_FRACTION if moves > 1 else available)
+    return min(soft, hard), hard
+
+
+def clock_limits(white_to_move:bool, wtime:float, btime:float, winc=0.0, binc=0.0, movestogo=None,
+                 move_overhead=DEFAULT_MOVE_OVERHEAD) -> tuple:
+    """
+        allocate_time for whichever side is to move
+    """
+    if white_to_move:
+        return allocate_time(wtime, winc, movestogo, move_overhead)
+    return allocate_time(btime, binc, movestogo, move_overhead)
+
+
+class TimeManager():
+    """
+        Decides when a search should stop. Pass should_stop to Search.should_stop and on_iteration
+        to Search.search.
+
+        Without limits (when pondering) the search runs until stop() is called or start() gives it
+        limits.
+    """
+
+    def __init__(self, soft=None, hard=None) -> None:
+        self.soft = soft
+        self.hard = hard
+        self.start_time = time.perf_counter()
+        self.stopped = False
+        self.best_move = None
+        self.stable_iterations = 0
+        self.scale = 1.0
+        # Time searched before start() was called (pondering), credited against the soft limit
+        self.pondered = 0.0
+
+    def start(self, soft:float, hard:float):
+        """
+            Starts the clock with new limits on a ponder hit. Best move stability carries over and the
+            time already spent pondering counts towards the soft limit, so if an iteration has finished
+            and the soft limit is already used up the search stops straight away.
+        """
+        now = time.perf_counter()
+        pondered = now - self.start_time
+        ### The search thread calls should_stop while this runs. The clock is restarted before the
+        ### limits are set, so it never sees the new hard limit against the time spent pondering
+        self.start_time = now
+        self.pondered = pondered
+        self.soft = soft
+        self.hard = hard
+        if self.best_move is not None and self._soft_limit_reached():
+            self.stopped = True
+
+    def stop(self):
+        self.stopped = True
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start_time
+
+    def should_stop(self) -> bool:
+        return self.stopped or (self.hard is not None and self.elapsed() >= self.hard)
+
+    def _soft_limit_reached(self) -> bool:
+        return self.soft is not None and self.pondered + self.elapsed() >= self.soft * self.scale * NEXT_ITERATION_FRACTION
+
+    def on_iteration(self, result):
+        ### A best move that has only just changed needs more checking, a stable one needs less
+        if self.best_move is not None and result.move != self.best_move:
+            self.stable_iterations = 0
+            self.scale = BEST_MOVE_CHANGE_SCALE
+        elif self.best_move is not None:
+            self.stable_iterations += 1
+            self.scale = max(STABLE_ITERATION_SCALE ** self.stable_iterations, MIN_STABILITY_SCALE)
+        self.best_move = result.move
+
+        if self._soft_limit_reached():
+            self.stopped = True
+
+
+class TimedPlayer():
+    """
+        Plays timed games with a Search, pondering on the opponent's time
+    """
+
+    def __init__(self, search=None, move_overhead=DEFAULT_MOVE_OVERHEAD) -> None:
+        self.search = search if search is not None else Search()
+        self.move_overhead = move_overhead
+        self.ponder_move = None
+        self._ponder_manager = None
+        self._ponder_thread = None
+        self._ponder_result = None
+
+    def _limits(self, position, wtime, btime, winc, binc, movestogo) -> tuple:
+        return clock_limits(position.whiteToMove, wtime, btime, winc, binc, movestogo, self.move_overhead)
+
+    def _run(self, position, manager:TimeManager):
+        self.search.should_stop = manager.should_stop
+        try:
+            return self.search.search(position, depth=MAX_DEPTH, on_iteration=manager.on_iteration)
+        finally:
+            self.search.should_stop = None
+
+    def go(self, position, wtime:float, btime:float, winc=0.0, binc=0.0, movestogo=None):
+        """
+            Searches the position within the time allocated from the clock. Returns the SearchResult.
+        """
+        self.stop_pondering()
+        manager = TimeManager(*self._limits(position, wtime, btime, winc, binc, movestogo))
+        return self._run(position, manager)
+
+    def ponder(self, position, result) -> bool:
+        """
+            Starts pondering after our move. position is the position after the move in result,
+            and the reply expected is the next move in its principal variation. Returns False if
+            there is no reply to ponder on.
+        """
+        self.stop_pondering()
+        if len(result.pv) < 2:
+            return False
+        self.ponder_move = result.pv[1]
+        ponder_position = position.copy()
+        ponder_position.makeMove(self.ponder_move[0], self.ponder_move[1], self.ponder_move[2] or 'Q')
+        manager = self._ponder_manager = TimeManager()
+        self._ponder_result = None
+
+        def run():
+            self._ponder_result = self._run(ponder_position, manager)
+
+        self._ponder_thread = threading.Thread(target=run, name='ponder', daemon=True)
+        self._ponder_thread.start()
+        return True
+
+    def stop_pondering(self):
+        """
+            Stops a ponder search, e.g. when the opponent plays an unexpected move or the game ends
+        """
+        if self._ponder_thread is not None:
+            self._ponder_manager.stop()
+            self._ponder_thread.join()
+        self._clear_ponder()
+
+    def _clear_ponder(self):
+        self.ponder_move = None
+        self._ponder_manager = None
+        self._ponder_thread = None
+        self._ponder_result = None
+
+    def opponent_moved(self, move:tuple, position, wtime:float, btime:float, winc=0.0, binc=0.0, movestogo=None):
+        """
+            Called with the opponent's move and the position after it. On a ponder hit the ponder
+            search continues with the clock started, otherwise a new search is run. Returns the SearchResult.
+        """
+        if self._ponder_thread is None or move != self.ponder_move:
+            return self.go(position, wtime, btime, winc, binc, movestogo)
+
+        ### The ponder search stops now if it has already used the soft limit, otherwise at the end of
+        ### an iteration or the hard limit like a normal search. If it already finished (e.g. it found
+        ### a forced mate) the join returns straight away.
+        self._ponder_manager.start(*self._limits(position, wtime, btime, winc, binc, movestogo))
+        self._ponder_thread.join()
+        result = self._ponder_result
+        self._clear_ponder()
+        return result
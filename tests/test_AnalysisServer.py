@@ -0,0 +1,119 @@
+import asyncio
+import json
+import os
+import signal
+import time
+
+from AnalysisServer import DEFAULT_ANALYSE_MOVETIME, TIMEOUT_GRACE, AnalysisServer
+
+STARTING_MOVES = 20
+
+
+class Client():
+
+    def __init__(self, reader, writer) -> None:
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, **request):
+        self.writer.write((json.dumps(request) + '\n').encode())
+        await self.writer.drain()
+
+    async def read(self) -> dict:
+        return json.loads(await self.reader.readline())
+
+
+def run_server(test, **kwargs):
+    """
+        Runs test(server, client) against a server on a Unix socket
+    """
+    async def main(path):
+        server = AnalysisServer(**kwargs)
+        await server.start(unix_path=path)
+        client = Client(*await asyncio.open_unix_connection(path))
+        try:
+            await test(server, client)
+        finally:
+            await server.close()
+            client.writer.close()
+
+    path = f'/tmp/analysis-server-test-{os.getpid()}.sock'
+    try:
+        asyncio.run(main(path))
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def test_legal_moves_and_cancel():
+    async def test(server, client):
+        await client.send(id=1, cmd='legal_moves')
+        response = await client.read()
+        assert response['ok'] and len(response['result']['moves']) == STARTING_MOVES
+
+        await client.send(id=2, cmd='analyse', movetime=5, timeout=5)
+        await client.send(id=3, cmd='cancel', target=2)
+        responses = {response['id']: response for response in [await client.read(), await client.read()]}
+        assert responses[3] == {'id': 3, 'ok': True, 'result': {'target': 2}}
+        assert not responses[2]['ok'] or responses[2]['result']['cancelled']
+
+        await client.send(id=4, cmd='cancel', target=99)
+        assert not (await client.read())['ok']
+
+    run_server(test, workers=1)
+
+
+def test_bare_analyse_uses_default_movetime():
+    async def test(server, client):
+        start = time.perf_counter()
+        await client.send(id=1, cmd='analyse')
+        response = await client.read()
+        assert response['ok'] and response['result']['bestmove']
+        assert time.perf_counter() - start < DEFAULT_ANALYSE_MOVETIME + TIMEOUT_GRACE
+
+    run_server(test, workers=1)
+
+
+def test_queued_request_answered_within_budget():
+    async def test(server, client):
+        start = time.perf_counter()
+        # The first request keeps the only worker busy for longer than the second one's budget
+        await client.send(id=1, cmd='analyse', movetime=3, timeout=3)
+        await client.send(id=2, cmd='analyse', timeout=1)
+        response = await client.read()
+        assert response['id'] == 2 and response['error'] == 'timed out'
+        assert time.perf_counter() - start < 1 + TIMEOUT_GRACE + 0.5
+        assert (await client.read())['ok']
+
+    run_server(test, workers=1, queue_size=1)
+
+
+def test_dead_worker_fails_its_request_and_restarts():
+    async def test(server, client):
+        worker = server.workers[0]
+        pid = worker.process.pid
+        await client.send(id=1, cmd='analyse', movetime=5, timeout=5)
+        await client.send(id=2, cmd='legal_moves')
+        while worker.current is None:
+            await asyncio.sleep(0.01)
+        os.kill(pid, signal.SIGKILL)
+
+        response = await client.read()
+        assert response['id'] == 1 and 'worker failed' in response['error']
+        # The queued request is run by the new process
+        response = await client.read()
+        assert response['id'] == 2 and response['ok']
+        assert worker.process.pid != pid
+
+    run_server(test, workers=1)
+
+
+def test_close_with_client_connected():
+    async def test(server, client):
+        await client.send(id=1, cmd='analyse', movetime=5, timeout=5)
+        while server.workers[0].current is None:
+            await asyncio.sleep(0.01)
+        await server.close()
+        assert await client.reader.readline() == b''
+
+    run_server(test, workers=1)
@@ -0,0 +1,38 @@
+import io
+import json
+
+from BatchAnalysis import analyse_position, parse_operations, run_batch
+from Search import Search
+
+BACK_RANK = '6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - -'
+
+
+def test_parse_operations():
+    assert parse_operations('bm Qxf7+; id "WAC.001";') == {'bm': ['Qxf7+'], 'id': ['WAC.001']}
+
+
+def test_solved():
+    result = analyse_position(Search(), f'{BACK_RANK} bm Rd8#; id "back rank";', depth=2)
+    assert result['id'] == 'back rank'
+    assert result['best_move'] == 'd1d8' and result['solved']
+    assert 'invalid_moves' not in result
+
+
+def test_bad_best_move_keeps_search_result():
+    result = analyse_position(Search(), f'{BACK_RANK} bm Rd8# Qh5;', depth=2)
+    assert result['best_move'] == 'd1d8' and result['solved']
+    assert result['invalid_moves'] == ['Qh5']
+
+    result = analyse_position(Search(), f'{BACK_RANK} bm Qh5;', depth=2)
+    assert result['best_move'] == 'd1d8'
+    assert 'solved' not in result and result['invalid_moves'] == ['Qh5']
+
+
+def test_checkmate_and_summary():
+    output = io.StringIO()
+    lines = [f'{BACK_RANK} bm Rd8#;', '3R2k1/5ppp/8/8/8/8/5PPP/6K1 b - -', 'not a fen']
+    summary = run_batch(lines, output, workers=1, depth=2)
+    results = sorted((json.loads(line) for line in output.getvalue().splitlines()), key=lambda result: result['index'])
+    assert results[1]['checkmate'] and results[1]['legal_moves'] == 0
+    assert 'error' in results[2]
+    assert summary['positions'] == 3 and summary['errors'] == 1 and summary['solved'] == 1
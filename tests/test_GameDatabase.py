@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+import ChessEngine
+from GameDatabase import MAX_MOVES, MAX_TAGS_LENGTH, GameDatabase, decode_move, encode_move, import_pgn, read_pgn
+from Notation import parse_uci
+
+PGN = """[Event "First"]
+[Result "1-0"]
+
+1. e4 e5 2. Nf3 {a comment; with a semicolon} Nc6 (2... d6 3. d4 (3. Bc4) exd4) 3. Bb5 $1 a6 1-0
+
+[Event "Second"]
+
+1. e4 c5 2. Nf3 ; rest of the line is a comment 1-0
+d6 1/2-1/2
+1.d4 d5 2.c4 0-1 1. e4 e5 2. Nf3 Nf6 *
+[Event "Illegal"]
+
+1. e4 e4 1-0
+"""
+MORE_PGN = """1. e4 e5 2. Nc3 1/2-1/2
+1. e4 e5 2. Nf3 Nc6 0-1
+"""
+
+
+def position_after(*ucis):
+    position = ChessEngine.Position()
+    for uci in ucis:
+        old, new, promotion = parse_uci(uci)
+        position.makeMove(old, new, promotion or 'Q')
+    return position
+
+
+@pytest.fixture
+def database(tmp_path):
+    with GameDatabase(os.path.join(tmp_path, 'games.cgd')) as database:
+        yield database
+
+
+def test_read_pgn_splits_on_results():
+    games = list(read_pgn(PGN.splitlines()))
+    assert [(tags.get('Event'), moves, result) for tags, moves, result in games] == [
+        ('First', ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5', 'a6'], '1-0'),
+        ('Second', ['e4', 'c5', 'Nf3', 'd6'], '1/2-1/2'),
+        (None, ['d4', 'd5', 'c4'], '0-1'),
+        (None, ['e4', 'e5', 'Nf3', 'Nf6'], '*'),
+        ('Illegal', ['e4', 'e4'], '1-0'),
+    ]
+
+
+def test_import_and_explore(database):
+    assert import_pgn(database, PGN.splitlines()) == (4, 1)
+    assert database.update_index(run_entries=3) == 4
+    assert database.update_index() == 0
+
+    games = list(database.iter_games())
+    assert [game.result for game in games] == ['1-0', '1/2-1/2', '0-1', '*']
+    assert games[0].tags['Event'] == 'First'
+    assert database.read_game(games[2].offset) == games[2]
+
+    start = database.explore(ChessEngine.Position())
+    assert (start.games, start.white_wins, start.draws, start.black_wins) == (4, 1, 1, 1)
+    assert [(stats.move, stats.games) for stats in start.moves] == [(parse_uci('e2e4'), 3), (parse_uci('d2d4'), 1)]
+
+    after_nf3 = database.explore(position_after('e2e4', 'e7e5', 'g1f3'))
+    assert after_nf3.games == 2
+    assert {stats.move for stats in after_nf3.moves} == {parse_uci('b8c6'), parse_uci('g8f6')}
+    assert sorted(database.find_games(position_after('e2e4', 'e7e5'))) == [games[0].offset, games[3].offset]
+    assert database.explore(position_after('a2a3')).games == 0
+
+
+def test_reimport_merges_into_index(database):
+    import_pgn(database, PGN.splitlines())
+    database.update_index()
+    size = len(database)
+    assert import_pgn(database, MORE_PGN.splitlines()) == (2, 0)
+    # Not visible until the index is updated
+    assert database.explore(ChessEngine.Position()).games == 4
+    assert database.update_index(run_entries=2) == 2
+    assert len(database) > size
+
+    start = database.explore(ChessEngine.Position())
+    assert (start.games, start.white_wins, start.draws, start.black_wins) == (6, 1, 2, 2)
+    after_e5 = database.explore(position_after('e2e4', 'e7e5'))
+    assert [(stats.move, stats.games) for stats in after_e5.moves] == [(parse_uci('g1f3'), 3), (parse_uci('b1c3'), 1)]
+
+    # Reopening reads the merged index back
+    path = database.path
+    database.close()
+    with GameDatabase(path) as reopened:
+        assert reopened.explore(ChessEngine.Position()).games == 6
+        assert reopened.update_index() == 0
+
+
+def test_record_limits(database):
+    with pytest.raises(ValueError):
+        database.add_game([], tags={'Event': 'x' * MAX_TAGS_LENGTH})
+    with pytest.raises(ValueError):
+        database.add_game([((4,6),(4,4),'')] * (MAX_MOVES + 1))
+    assert list(database.iter_games()) == []
+
+
+def test_move_encoding():
+    for move in [((4,6),(4,4),''), ((0,1),(0,0),'Q'), ((7,1),(6,0),'N')]:
+        assert decode_move(encode_move(move)) == move
@@ -0,0 +1,66 @@
+import json
+import os
+import threading
+
+import pytest
+
+import ChessEngine
+import Instrumentation
+
+
+@pytest.fixture(autouse=True)
+def clean_stats():
+    Instrumentation.reset()
+    yield
+    Instrumentation.disable()
+    Instrumentation.reset()
+
+
+def test_profiled_restores_methods():
+    original = ChessEngine.GameState.getValidMoves
+    with Instrumentation.profiled():
+        assert ChessEngine.GameState.getValidMoves is not original
+        ChessEngine.GameState().getValidMoves()
+    assert ChessEngine.GameState.getValidMoves is original
+    stats = Instrumentation.snapshot()['functions']
+    assert stats['getValidMoves']['calls'] == 1
+    assert stats['getValidMoves']['own_seconds'] <= stats['getValidMoves']['total_seconds']
+
+
+def test_reset_keeps_counting():
+    with Instrumentation.profiled():
+        ChessEngine.GameState().getValidMoves()
+        Instrumentation.reset()
+        assert Instrumentation.snapshot()['functions'] == {}
+        ChessEngine.GameState().getValidMoves()
+    assert Instrumentation.snapshot()['functions']['getValidMoves']['calls'] == 1
+
+
+def test_threads_have_their_own_call_stack():
+    def run():
+        gs = ChessEngine.GameState()
+        for _ in range(5):
+            gs.getValidMoves()
+
+    with Instrumentation.profiled():
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    stats = Instrumentation.snapshot()['functions']
+    assert stats['getValidMoves']['calls'] == 20
+    for stat in stats.values():
+        assert stat['own_seconds'] >= 0
+
+
+def test_worker_writes_its_own_snapshot(tmp_path, monkeypatch):
+    target = os.path.join(tmp_path, 'profile.json')
+    monkeypatch.setenv(Instrumentation.ENV_VAR, target)
+    Instrumentation.worker_started()
+    ChessEngine.GameState().getValidMoves()
+    Instrumentation.worker_finished()
+    path = Instrumentation.process_path(target)
+    assert path == os.path.join(tmp_path, f'profile.{os.getpid()}.json')
+    with open(path) as f:
+        assert json.load(f)['functions']['getValidMoves']['calls'] == 1
@@ -0,0 +1,67 @@
+import pytest
+
+import ChessEngine
+from Notation import move_to_san, move_to_uci, parse_san, parse_uci
+
+# Knights on b1 and g1, only the g1 knight can reach f3 once e2 and d2 are blocked
+TWO_KNIGHTS = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+CASTLING = '4k3/8/8/8/8/8/8/R3K2R w KQ - 0 1'
+# Rooks on a1 and h1 can both reach d1
+TWO_ROOKS = '4k3/8/8/8/8/8/4K3/R6R w - - 0 1'
+PROMOTION = '8/P7/8/8/8/8/8/k6K w - - 0 1'
+
+
+def game(fen:str) -> ChessEngine.GameState:
+    return ChessEngine.GameState(ChessEngine.Position.from_fen(fen))
+
+
+def test_uci_round_trip():
+    assert move_to_uci(((4,6),(4,4),'')) == 'e2e4'
+    assert parse_uci('a7a8q') == ((0,1),(0,0),'Q')
+    with pytest.raises(ValueError):
+        parse_uci('e2')
+
+
+@pytest.mark.parametrize('san, uci', [
+    ('Nf3', 'g1f3'),
+    ('Ngf3', 'g1f3'),
+    ('Ng1f3', 'g1f3'),
+    ('Ng1-f3', 'g1f3'),
+    ('e4', 'e2e4'),
+    ('e2e4', 'e2e4'),
+    ('Nc3!?', 'b1c3'),
+])
+def test_parse_san(san, uci):
+    assert move_to_uci(parse_san(game(TWO_KNIGHTS), san)) == uci
+
+
+def test_parse_san_castling_and_disambiguation():
+    gs = game(CASTLING)
+    assert move_to_uci(parse_san(gs, 'O-O')) == 'e1g1'
+    assert move_to_uci(parse_san(gs, '0-0-0')) == 'e1c1'
+    gs = game(TWO_ROOKS)
+    assert move_to_uci(parse_san(gs, 'Rad1')) == 'a1d1'
+    assert move_to_uci(parse_san(gs, 'Rhd1+')) == 'h1d1'
+    with pytest.raises(ValueError):
+        parse_san(gs, 'Rd1')
+
+
+def test_parse_san_promotion():
+    gs = game(PROMOTION)
+    assert move_to_uci(parse_san(gs, 'a8=Q')) == 'a7a8q'
+    assert move_to_uci(parse_san(gs, 'a8N')) == 'a7a8n'
+    with pytest.raises(ValueError):
+        parse_san(gs, 'a8')
+
+
+@pytest.mark.parametrize('san', ['Nf4', 'Ke2', 'Nbf3', 'xyz', ''])
+def test_parse_san_rejects(san):
+    with pytest.raises(ValueError):
+        parse_san(game(TWO_KNIGHTS), san)
+
+
+def test_san_round_trip():
+    gs = game('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1')
+    move_list = gs.getMoveList()
+    for move in move_list:
+        assert parse_san(gs, move_to_san(gs, move, move_list), move_list) == move
@@ -0,0 +1,98 @@
+import os
+import random
+
+import pytest
+
+import ChessEngine
+from Notation import parse_uci
+from OpeningBook import ENTRY_STRUCT, BookMove, OpeningBook, decode_move, polyglot_key
+
+# Reference keys from the Polyglot specification
+REFERENCE_KEYS = [
+    ([], 0x463b96181691fc9c),
+    (['e2e4'], 0x823c9b50fd114196),
+    (['e2e4', 'd7d5'], 0x0756b94461c50fb0),
+    (['e2e4', 'd7d5', 'e4e5'], 0x662fafb965db29d4),
+    (['e2e4', 'd7d5', 'e4e5', 'f7f5'], 0x22a48b5a8e47ff78),
+    (['e2e4', 'd7d5', 'e4e5', 'f7f5', 'e1e2'], 0x652a607ca3f242c1),
+    (['e2e4', 'd7d5', 'e4e5', 'f7f5', 'e1e2', 'e8f7'], 0x00fdd303c946bdd9),
+    (['a2a4', 'b7b5', 'h2h4', 'b5b4', 'c2c4'], 0x3c8123ea7b067637),
+    (['a2a4', 'b7b5', 'h2h4', 'b5b4', 'c2c4', 'b4c3', 'a1a3'], 0x5c3f9b829b279560),
+]
+CASTLING = 'r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1'
+
+
+def polyglot_move(uci:str) -> int:
+    """
+        Encodes a UCI move the way Polyglot stores it (castling is already king-takes-rook here)
+    """
+    (old_x, old_y), (new_x, new_y), promotion = parse_uci(uci)
+    promotion_code = ' nbrq'.index(promotion.lower() or ' ')
+    return new_x | (7 - new_y) << 3 | old_x << 6 | (7 - old_y) << 9 | promotion_code << 12
+
+
+def play(ucis:list):
+    position = ChessEngine.Position()
+    for uci in ucis:
+        old, new, promotion = parse_uci(uci)
+        position.makeMove(old, new, promotion or 'Q')
+    return position
+
+
+@pytest.mark.parametrize('moves, key', REFERENCE_KEYS)
+def test_reference_keys(moves, key):
+    position = play(moves)
+    assert polyglot_key(position) == key
+    assert polyglot_key(ChessEngine.GameState(position)) == key
+
+
+def test_decode_castling():
+    board = ChessEngine.Position.from_fen(CASTLING).board
+    assert decode_move(polyglot_move('e1h1'), board) == parse_uci('e1g1')
+    assert decode_move(polyglot_move('e1a1'), board) == parse_uci('e1c1')
+    assert decode_move(polyglot_move('e8h8'), board) == parse_uci('e8g8')
+    assert decode_move(polyglot_move('e2e4'), ChessEngine.Position().board) == parse_uci('e2e4')
+    assert decode_move(polyglot_move('a7a8q'), board) == parse_uci('a7a8q')
+
+
+@pytest.fixture
+def book(tmp_path):
+    start = polyglot_key(ChessEngine.Position())
+    castling = polyglot_key(ChessEngine.Position.from_fen(CASTLING))
+    entries = [
+        (start, polyglot_move('e2e4'), 10, 0),
+        (start, polyglot_move('d2d4'), 20, 0),
+        (start, polyglot_move('g1f3'), 0, 0),
+        # Not legal in the starting position
+        (start, polyglot_move('e2e5'), 50, 0),
+        (castling, polyglot_move('e1h1'), 5, 0),
+    ]
+    path = os.path.join(tmp_path, 'book.bin')
+    with open(path, 'wb') as f:
+        f.write(b''.join(ENTRY_STRUCT.pack(*entry) for entry in sorted(entries)))
+    with OpeningBook(path) as book:
+        yield book
+
+
+def test_get_moves(book):
+    assert len(book) == 5
+    gs = ChessEngine.GameState()
+    assert book.get_moves(gs) == [BookMove(*parse_uci('d2d4'), 20), BookMove(*parse_uci('e2e4'), 10)]
+    assert len(book.get_moves(gs, minimum_weight=0)) == 3
+    castling = ChessEngine.GameState(ChessEngine.Position.from_fen(CASTLING))
+    assert book.get_moves(castling) == [BookMove(*parse_uci('e1g1'), 5)]
+    assert book.get_moves(ChessEngine.GameState(play(['a2a3']))) == []
+
+
+def test_choose_move(book):
+    gs = ChessEngine.GameState()
+    moves = {book.choose_move(gs, random.Random(seed))[:2] for seed in range(20)}
+    assert moves == {parse_uci('d2d4')[:2], parse_uci('e2e4')[:2]}
+    assert book.choose_move(ChessEngine.GameState(play(['a2a3']))) is None
+
+
+def test_empty_book(tmp_path):
+    path = os.path.join(tmp_path, 'empty.bin')
+    open(path, 'wb').close()
+    with OpeningBook(path) as book:
+        assert len(book) == 0 and book.get_moves(ChessEngine.GameState()) == []
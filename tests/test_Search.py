@@ -0,0 +1,49 @@
+import pytest
+
+import ChessEngine
+from Notation import move_to_uci
+from Search import MATE_SCORE, Search
+
+START = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+KIWIPETE = 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1'
+POSITION_3 = '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1'
+POSITION_4 = 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1'
+POSITION_5 = 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8'
+
+
+@pytest.mark.parametrize('fen, depth, nodes', [
+    (START, 1, 20),
+    (START, 2, 400),
+    (START, 3, 8902),
+    (KIWIPETE, 1, 48),
+    (KIWIPETE, 2, 2039),
+    (POSITION_3, 1, 14),
+    (POSITION_3, 2, 191),
+    (POSITION_3, 3, 2812),
+    (POSITION_4, 1, 6),
+    (POSITION_4, 2, 264),
+    (POSITION_4, 3, 9467),
+    (POSITION_5, 1, 44),
+    (POSITION_5, 2, 1486),
+])
+def test_perft(fen, depth, nodes):
+    assert Search().perft(ChessEngine.Position.from_fen(fen), depth) == nodes
+
+
+@pytest.mark.parametrize('fen, depth, move, mate_in', [
+    # Back rank mate
+    ('6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1', 2, 'd1d8', 1),
+    # Scholar's mate
+    ('r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4', 2, 'h5f7', 1),
+    # Qxh8+ Kxh8 Bf6+ Kg8 Re8#
+    ('r1b3kr/ppp1Bp1p/1b6/n2P4/2p3q1/2Q2N2/P4PPP/RN2R1K1 w - - 1 0', 5, 'c3h8', 3),
+])
+def test_mate_in_n(fen, depth, move, mate_in):
+    result = Search().search(ChessEngine.Position.from_fen(fen), depth=depth)
+    assert move_to_uci(result.move) == move
+    assert result.score == MATE_SCORE - (2*mate_in - 1)
+
+
+def test_mated_side_scores_loss():
+    result = Search().search(ChessEngine.Position.from_fen('6k1/5ppp/8/8/8/8/5PPP/3R2K1 b - - 0 1'), depth=3)
+    assert result.score < MATE_SCORE // 2
@@ -0,0 +1,92 @@
+import os
+import zlib
+from array import array
+
+import pytest
+
+import ChessEngine
+from Tablebase import (FILE_EXTENSION, HEADER_STRUCT, INVALID, MAGIC, MAX_PIECES, OFFSET_STRUCT, VERSION,
+                       Tablebase, TablebaseResult, encode_result, position_index, table_size)
+
+PIECES = ['wK','wQ','bK']
+BLOCK_ENTRIES = 4096
+# White to move, mate in 1 with Qb7
+MATE_IN_ONE = 'k7/8/1K6/8/8/8/8/1Q6 w - - 0 1'
+DRAWN = 'k7/8/8/8/8/8/8/1Q5K b - - 0 1'
+
+
+def square(name:str) -> int:
+    return (8 - int(name[1]))*8 + ord(name[0]) - ord('a')
+
+
+def write_ctb(path:str, pieces:list, values:array, block_entries=BLOCK_ENTRIES):
+    """
+        Writes a table in the .ctb layout without going through TablebaseGenerator (which needs NumPy)
+    """
+    block_count = (len(values) + block_entries - 1) // block_entries
+    header = HEADER_STRUCT.pack(MAGIC, VERSION, len(pieces), block_entries, block_count) + ''.join(pieces).encode('ascii')
+    blocks = [zlib.compress(values[start:start + block_entries].tobytes()) for start in range(0, len(values), block_entries)]
+    offset = len(header) + OFFSET_STRUCT.size*(block_count + 1)
+    offsets = []
+    for block in blocks:
+        offsets.append(offset)
+        offset += len(block)
+    offsets.append(offset)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(b''.join(OFFSET_STRUCT.pack(offset) for offset in offsets))
+        f.write(b''.join(blocks))
+
+
+@pytest.fixture
+def kqvk(tmp_path):
+    values = array('h', [INVALID]) * table_size(len(PIECES))
+    values[position_index([square('b6'), square('b7'), square('b8')], False)] = encode_result(-1, 0)
+    values[position_index([square('b6'), square('b1'), square('a8')], True)] = encode_result(1, 1)
+    values[position_index([square('h1'), square('b1'), square('a8')], False)] = encode_result(0, 0)
+    write_ctb(os.path.join(tmp_path, 'KQvK' + FILE_EXTENSION), PIECES, values)
+    with Tablebase(str(tmp_path), cache_blocks=2) as tablebase:
+        yield tablebase
+
+
+def probe_fen(tablebase:Tablebase, fen:str):
+    position = ChessEngine.Position.from_fen(fen)
+    return tablebase.probe(position.board, position.whiteToMove)
+
+
+def test_round_trip(kqvk):
+    assert kqvk.available == {'KQvK'}
+    assert probe_fen(kqvk, '1k6/1Q6/1K6/8/8/8/8/8 b - - 0 1') == TablebaseResult(-1, 0)
+    assert probe_fen(kqvk, MATE_IN_ONE) == TablebaseResult(1, 1)
+    assert probe_fen(kqvk, DRAWN) == TablebaseResult(0, 0)
+    # Entries that were never filled in are invalid placements
+    assert probe_fen(kqvk, 'k7/8/8/8/8/8/8/1Q5K w - - 0 1') is None
+
+
+def test_mirrored_colours(kqvk):
+    # Black is the stronger side, so the board is flipped onto the KQvK table
+    assert probe_fen(kqvk, '1q5k/8/8/8/8/8/8/K7 w - - 0 1') == TablebaseResult(0, 0)
+    assert probe_fen(kqvk, '8/8/8/8/8/1k6/1q6/1K6 w - - 0 1') == TablebaseResult(-1, 0)
+
+
+def test_missing_tables(kqvk):
+    assert probe_fen(kqvk, 'k7/8/1K6/8/8/8/8/1R6 w - - 0 1') is None
+    assert probe_fen(kqvk, 'k7/8/1K6/8/8/8/8/QR6 w - - 0 1') is None
+    assert MAX_PIECES == 3
+
+
+def test_block_cache(kqvk):
+    probe_fen(kqvk, MATE_IN_ONE)
+    probe_fen(kqvk, MATE_IN_ONE)
+    assert (kqvk.misses, kqvk.hits) == (1, 1)
+
+
+def test_generator_writes_readable_tables(tmp_path):
+    np = pytest.importorskip('numpy')
+    from TablebaseGenerator import write_table
+
+    values = np.full(table_size(len(PIECES)), INVALID, dtype=np.int16)
+    values[position_index([square('b6'), square('b1'), square('a8')], True)] = encode_result(1, 1)
+    write_table(os.path.join(tmp_path, 'KQvK' + FILE_EXTENSION), PIECES, values, block_entries=1000)
+    with Tablebase(str(tmp_path)) as tablebase:
+        assert probe_fen(tablebase, MATE_IN_ONE) == TablebaseResult(1, 1)
@@ -0,0 +1,45 @@
+import time
+
+import ChessEngine
+from Search import Search
+from TimeManagement import TimedPlayer, TimeManager, allocate_time
+
+
+def test_allocate_time():
+    soft, hard = allocate_time(60, 1)
+    assert 0 < soft <= hard <= 30
+    # With one move to go the whole clock (less the overhead) can be used
+    soft, hard = allocate_time(10, movestogo=1)
+    assert hard > 9
+
+
+def test_start_restarts_the_clock():
+    manager = TimeManager()
+    manager.start_time -= 5
+    manager.start(10, 1)
+    assert not manager.should_stop()
+    assert manager.pondered >= 5 and manager.elapsed() < 1
+
+
+def test_ponder_time_counts_towards_soft_limit():
+    manager = TimeManager()
+    manager.best_move = ((4, 6), (4, 4), '')
+    manager.start_time -= 5
+    manager.start(1, 10)
+    assert manager.stopped
+
+
+def test_ponder_hit():
+    player = TimedPlayer(Search())
+    position = ChessEngine.Position()
+    result = player.go(position, wtime=2, btime=2)
+    position.makeMove(*result.move[:2], result.move[2] or 'Q')
+    if player.ponder(position, result):
+        reply = player.ponder_move
+        after = position.copy()
+        after.makeMove(*reply[:2], reply[2] or 'Q')
+        start = time.perf_counter()
+        result = player.opponent_moved(reply, after, wtime=2, btime=2)
+        assert result.move is not None
+        assert time.perf_counter() - start < 2
+        assert player.ponder_move is None